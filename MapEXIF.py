@@ -1,7 +1,16 @@
 #!/usr/bin/env python
+import io
 import os
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS      
+import sys
+import csv
+import math
+import json
+import struct
+import zipfile
+import argparse
+import collections
+import multiprocessing
+from xml.sax.saxutils import escape
 
 ##########################################################
 #Name:              MapEXIF.py
@@ -11,6 +20,56 @@ from PIL.ExifTags import TAGS, GPSTAGS
 #Author:            Rob Cilla
 ##########################################################
 
+# IFD0 tag pointing at the GPS IFD, every other IFD0 tag is skipped
+EXIF_TAGS = {
+    0x8825: "GPSInfo",
+}
+
+# GPS tags needed to build a coordinate
+GPS_TAGS = {
+    1: "GPSLatitudeRef",
+    2: "GPSLatitude",
+    3: "GPSLongitudeRef",
+    4: "GPSLongitude",
+}
+
+# KML written before the first placemark and after the last
+KML_HEADER = "<?xml version='1.0' encoding='UTF-8'?>\n<kml xmlns='http://earth.google.com/kml/2.1'>\n<Document>\n"
+KML_FOOTER = "</Document>\n</kml>"
+
+# decimal places written for each coordinate, 6 is about 0.1m
+COORD_PRECISION = 6
+
+# base 32 alphabet of geohash cell names
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# bytes of placemarks buffered before they're written out to the KML file
+KML_BUFFER_SIZE = 1024 * 1024
+
+# tiled output: levels of the quadtree below the whole-world tile
+TILE_DEPTH = 8
+# placemarks a tile holds before the rest go down to its children
+TILE_CAPACITY = 256
+# tile files kept open at once, the least recently used is closed first
+MAX_OPEN_TILES = 64
+# bytes buffered per open tile file
+TILE_BUFFER_SIZE = 64 * 1024
+# on-screen size a tile's region must reach before its KML is loaded
+TILE_LOD_PIXELS = 128
+
+# image files handed to a worker process at a time
+CHUNK_SIZE = 64
+# chunks a worker may have queued or finished but not yet collected
+IN_FLIGHT_PER_WORKER = 4
+
+# TIFF field types of the tags above: (size of one value in bytes, struct
+# format code), entries of any other type are skipped
+TIFF_TYPES = {
+    2:  (1, "s"),      # ASCII, the N/S and E/W references
+    4:  (4, "L"),      # LONG, the GPS IFD offset
+    5:  (8, "L"),      # RATIONAL, degrees/minutes/seconds
+}
+
 '''
 convertToDegrees: takes in gps coords pulled from EXIF data and converts them to degrees
 @param: value of coordinate in minutes
@@ -37,113 +96,392 @@ def minToDeg(value):
 
 
 '''
-ripExif: searches for EXIF data on a single file
-@param: file to be searched
-@return: void
-'''        
-#pull exif data from a single file    
-def searchJPEG(imageFile):
-    #open file
-    f = open(imageFile, 'r')
+findExifSegment: walks the JPEG marker segments at the start of a file, jumping
+from one segment to the next using the big-endian segment lengths, until it
+finds the APP1 EXIF block or reaches the start of the image data
+@param: binary file object (anything with read and seek)
+@return: APP1 segment data starting with "Exif", None if there is no EXIF block
+'''
+def findExifSegment(fp):
+    #check for JPEG header
+    if fp.read(2) != b'\xFF\xD8':
+        return None
     
-    #read data from file
-    data = f.read()
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xFF':
+            #truncated file or lost sync with the segment structure
+            return None
+        
+        #markers may be padded with any number of 0xFF fill bytes
+        while marker[1:2] == b'\xFF':
+            marker = marker[1:2] + fp.read(1)
+            if len(marker) < 2:
+                return None
+        code = ord(marker[1:2])
+        
+        #TEM and RSTn markers stand alone without a length field
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        
+        #start of scan or end of image, there are no more headers
+        if code == 0xDA or code == 0xD9:
+            return None
+        
+        #segment length is big-endian and counts its own two bytes
+        lengthBytes = fp.read(2)
+        if len(lengthBytes) < 2:
+            return None
+        length = struct.unpack('>H', lengthBytes)[0] - 2
+        if length < 0:
+            return None
+        
+        #check for APP1 header
+        if code == 0xE1:
+            segment = fp.read(length)
+            if segment[:6] == b'Exif\x00\x00':
+                return segment
+            #an XMP or other APP1 block, keep searching for the EXIF one
+            continue
+        
+        #skip over the body of any other segment
+        fp.seek(length, os.SEEK_CUR)
+
+'''
+readIFD: decodes the requested tags from one TIFF image file directory
+@param: memoryview of the TIFF data, offset of the IFD, struct byte order,
+dict of tag ids to names (every other tag is skipped without decoding)
+@return: dict of decoded values keyed by tag name
+'''
+def readIFD(view, offset, order, tags):
+    values = {}
+    entryCount = struct.unpack_from(order + 'H', view, offset)[0]
+    for i in range(entryCount):
+        entry = offset + 2 + i * 12
+        tag, fieldType, count = struct.unpack_from(order + 'HHL', view, entry)
+        name = tags.get(tag)
+        if name is None or fieldType not in TIFF_TYPES:
+            continue
+        size, code = TIFF_TYPES[fieldType]
+        if size * count > len(view):
+            #corrupt count, the value can't fit in the block
+            continue
+        
+        #values of 4 bytes or less are stored in the entry itself
+        if size * count > 4:
+            dataOffset = struct.unpack_from(order + 'L', view, entry + 8)[0]
+        else:
+            dataOffset = entry + 8
+        
+        if fieldType == 2:
+            #ASCII, NUL terminated
+            value = view[dataOffset:dataOffset + count].tobytes().split(b'\x00', 1)[0]
+            if not isinstance(value, str):
+                value = value.decode('latin-1')
+            values[name] = value
+        elif fieldType == 5:
+            #rationals come back as (numerator, denominator) pairs
+            raw = struct.unpack_from('%s%d%s' % (order, count * 2, code), view, dataOffset)
+            pairs = tuple(zip(raw[0::2], raw[1::2]))
+            values[name] = pairs[0] if count == 1 else pairs
+        else:
+            raw = struct.unpack_from('%s%d%s' % (order, count, code), view, dataOffset)
+            values[name] = raw[0] if count == 1 else raw
+    return values
+
+'''
+decodeGPS: decodes the GPS tags straight from the APP1 EXIF block, without
+copying it or reopening the image
+@param: APP1 segment data as returned by findExifSegment
+@return: dict of GPS values keyed by tag name, empty if there are none
+'''
+def decodeGPS(exifSegment):
+    GPSData = {}
     
-    #initalize pointer for this file
-    ptr = 0
+    #TIFF header follows the "Exif\0\0" identifier, offsets are relative to it
+    view = memoryview(exifSegment)[6:]
+    byteOrder = view[0:2].tobytes()
+    if byteOrder == b'II':
+        order = '<'
+    elif byteOrder == b'MM':
+        order = '>'
+    else:
+        return GPSData
     
-    #close file
-    f.close()
+    try:
+        magic, ifdOffset = struct.unpack_from(order + 'HL', view, 2)
+        if magic != 42:
+            return GPSData
+        
+        #IFD0 holds the pointer to the GPS IFD
+        gpsOffset = readIFD(view, ifdOffset, order, EXIF_TAGS).get('GPSInfo')
+        if gpsOffset is not None:
+            GPSData = readIFD(view, gpsOffset, order, GPS_TAGS)
+    except struct.error:
+        #truncated or corrupt block, no coordinate can be trusted
+        pass
     
-    #initalize exif list for file
-    rippedExifLst = [] 
+    return GPSData
 
-    #check for JPEG header
-    if data[ptr:ptr+2] == b'\xFF\xD8': 
-        #print("DEBUG: IT'S A JPEG!")
-        #if JPEG, start search loop
-        while 1:                
-            #check for APP1 header
-            if data[ptr:ptr+2] == b'\xFF\xE1':
-                #print("DEBUG: APP1 data found")
-                #if APP1 found, check for EXIF data
-                if data[ptr + 4:ptr + 8] == b"Exif":  
-                    #print("DEBUG: EXIF FOUND FOR %s" % imageFile)
-    
-                    pilImage = Image.open(imageFile)
-                    EXIFData = pilImage._getexif()
-    
-                    #added file name to array
-                    rippedExifLst.append("Image: %s" % imageFile)
+'''
+searchJPEG: searches for GPS data in the EXIF block of a single file
+@param: file to be searched
+@return: [lat, lon, file name] list, or None if the file has no GPS data
+'''        
+#pull exif data from a single file    
+def searchJPEG(imageFile):
+    #only the JPEG headers are read, never the whole image
+    f = open(imageFile, 'rb')
+    try:
+        exifSegment = findExifSegment(f)
+    finally:
+        f.close()
     
-                    #iterate through tuples in EXIF data
-                    for tag, value in EXIFData.items():
-                        #pull value of EXIF tag
-                        tagsValue = TAGS.get(tag, tag)
+    #not a JPEG, or a JPEG without an APP1 EXIF block
+    if exifSegment is None:
+        #print("DEBUG: No EXIF data found")
+        return None
     
-                        if tagsValue == 'GPSInfo':
-                            #create a local gps dict
-                            gpsDict = {}
-                            for gpsRaw in value:
-                                #pull GPS tag from raw GPS data
-                                gpsTag = GPSTAGS.get(gpsRaw, gpsRaw)
-                                #populate dict with tags and values
-                                gpsDict[gpsTag] = value[gpsRaw]
+    #print("DEBUG: EXIF FOUND FOR %s" % imageFile)
+    gpsDict = decodeGPS(exifSegment)
     
-                                #ensure that the dict has the required info
-                                if (gpsDict.has_key("GPSLatitude") and
-                                    gpsDict.has_key("GPSLongitude") and 
-                                    gpsDict.has_key("GPSLongitudeRef") and
-                                    gpsDict.has_key("GPSLatitudeRef")):
-                                    
-                                    #pull values from the dict
-                                    latitude = gpsDict["GPSLatitude"]
-                                    latitideRef = gpsDict["GPSLatitudeRef"]
-                                    longitude = gpsDict["GPSLongitude"]
-                                    longitudeRef = gpsDict["GPSLongitudeRef"]   
-                                    
+    #ensure that the dict has the required info
+    if ("GPSLatitude" in gpsDict and
+        "GPSLongitude" in gpsDict and 
+        "GPSLongitudeRef" in gpsDict and
+        "GPSLatitudeRef" in gpsDict):
+        
+        #pull values from the dict
+        latitude = gpsDict["GPSLatitude"]
+        latitideRef = gpsDict["GPSLatitudeRef"]
+        longitude = gpsDict["GPSLongitude"]
+        longitudeRef = gpsDict["GPSLongitudeRef"]   
+        
+        #convert lat/long to degrees                                            
+        lat = minToDeg(latitude)
+        lon = minToDeg(longitude)
+        
+        if (lat and lon):
+            print("GPS data found for: %s" % os.path.basename(imageFile))
+        
+        #correct for the lat/long reference as necessary
+        if latitideRef == "S":
+            lat = 0 - lat
+        
+        if longitudeRef == "W":
+            lon = 0 - lon
+        
+        #names that aren't valid UTF-8 (raw bytes on Python 2, surrogate
+        #escaped on Python 3) get a replacement character in the output
+        name = os.path.basename(imageFile)
+        if sys.version_info[0] < 3:
+            name = name.decode('utf-8', 'replace').encode('utf-8')
+        else:
+            name = name.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+        
+        #build gps list
+        return [lat, lon, name]
     
-                                    #convert lat/long to degrees                                            
-                                    lat = minToDeg(latitude)
-                                    lon = minToDeg(longitude)
-                                    
-                                    if (lat and lon):
-                                        print("GPS data found for: %s" % os.path.basename(imageFile))
+    return None
+
+'''
+iterImages: lists the files to be searched under a path
+@param: imagePath - a single file, or a directory searched recursively
+@return: generator of file paths
+'''
+def iterImages(imagePath):
+    if os.path.isfile(imagePath):
+        yield imagePath
+        return
+    for root, dirs, files in os.walk(imagePath):
+        for f in files:
+            yield os.path.join(root, f)
+
+'''
+chunked: groups items into lists for the worker processes
+@param: iterable - items to group, consumed lazily
+@param: size - items per list
+@return: generator of lists, the last one may be short
+'''
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+'''
+searchJPEGs: searches a chunk of files for GPS data, one work unit of harvestGPS
+@param: files - list of files to be searched
+@return: list of [lat, lon, file name] lists for the files with GPS data
+'''
+def searchJPEGs(files):
+    coordList = []
+    for f in files:
+        try:
+            coords = searchJPEG(f)
+        except (IOError, OSError):
+            #unreadable file, one bad file shouldn't end the whole search
+            #print("DEBUG: Could not read %s" % f)
+            continue
+        if coords:
+            coordList.append(coords)
+    return coordList
+
+'''
+harvestGPS: searches files for GPS data across a pool of worker processes
+@param: files - iterable of files to be searched, consumed lazily
+@param: workers - processes in the pool (None = one per core, 1 = no pool)
+@param: chunkSize - files per work unit
+@param: maxInFlight - chunks handed out but not yet collected, bounding the
+memory held by results waiting on a slow chunk (None = 4 per worker)
+@return: generator of [lat, lon, file name] lists in file order
+'''
+def harvestGPS(files, workers=None, chunkSize=CHUNK_SIZE, maxInFlight=None):
+    chunks = chunked(files, chunkSize)
+    if workers == 1:
+        for chunk in chunks:
+            for coords in searchJPEGs(chunk):
+                yield coords
+        return
     
-                                    #correct for the lat/long reference as necessary
-                                    if latitideRef == "S":
-                                        lat = 0 - lat
+    if maxInFlight is None:
+        maxInFlight = IN_FLIGHT_PER_WORKER * (workers or multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(searchJPEGs, (chunk,)))
+            #once enough chunks are out, collect the oldest before handing out more
+            if len(pending) >= maxInFlight:
+                for coords in pending.popleft().get():
+                    yield coords
+        while pending:
+            for coords in pending.popleft().get():
+                yield coords
+        pool.close()
+    finally:
+        #stops any chunks still running if the caller gave up early
+        pool.terminate()
+        pool.join()
+
+'''
+gridKey: names the square grid cell a coordinate falls in
+@param: lat, lon - coords in degrees
+@param: cellSize - edge of a cell in degrees
+@return: (row, column) tuple
+'''
+def gridKey(lat, lon, cellSize):
+    return (int(math.floor(lat / cellSize)), int(math.floor(lon / cellSize)))
+
+'''
+geohash: names the geohash cell a coordinate falls in
+@param: lat, lon - coords in degrees
+@param: length - characters of geohash, each one splits the cell 32 ways
+@return: geohash string
+'''
+def geohash(lat, lon, length):
+    latRange = [-90.0, 90.0]
+    lonRange = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    #bits alternate between longitude and latitude, starting with longitude
+    even = True
+    while len(chars) < length:
+        if even:
+            coordRange, coord = lonRange, lon
+        else:
+            coordRange, coord = latRange, lat
+        mid = (coordRange[0] + coordRange[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            coordRange[0] = mid
+        else:
+            coordRange[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+'''
+clusterCoords: collapses coords falling in the same cell into one placemark,
+in a single pass with a dict keyed by cell
+@param: coordsIter - iterable of [lat, lon, file name] lists
+@param: cellKey - function of (lat, lon) naming the cell, see gridKey/geohash
+@return: list with, per cell, [lat, lon, file name] for a lone image or
+[mean lat, mean lon, "N images", file names] for a cluster, in the order
+each cell was first seen
+'''
+def clusterCoords(coordsIter, cellKey):
+    #cell -> [lat sum, lon sum, file names]
+    cells = collections.OrderedDict()
+    for lat, lon, name in coordsIter:
+        key = cellKey(lat, lon)
+        cell = cells.get(key)
+        if cell is None:
+            cells[key] = [lat, lon, [name]]
+        else:
+            cell[0] += lat
+            cell[1] += lon
+            cell[2].append(name)
     
-                                    if longitudeRef == "W":
-                                        lon = 0 - lon
-                                        
-                                    #build gps output string    
-                                    #gpsCoor = {"Latitude: ": lat, "Longitude: ": lon, "Latitude Reference: ": latitideRef, "Longitude Reference: ": longitudeRef}  
-                                
-                                    #build gps list
-                                    tmp = [lat, lon, os.path.basename(imageFile)]
-                                    
-                                    #add this image's data list to global list
-                                    coordList.append(tmp)
-
-                                    #use break to ensure only 1 entry per image
-                                    break                    
-                    #break out of search loop
-                    break
-                else:
-                    continue
-                    #continue searching for other APP1's w/EXIF data
-                    #print("DEBUG: No EXIF data found in this APPX ")                   
-            #check for EOF or ~64K header size limit
-            if data[ptr:ptr+2] == b'0xFFD9' or ptr > 4000:
-                #print("DEBUG: No EXIF data found")
-                #break out of search loop
-                break
-            else:
-                #keep advancing pointer to search for APP1 header
-                ptr = ptr + 2
-    else:
-        print("DEBUG: No EXIF data found")      
+    clusters = []
+    for latSum, lonSum, names in cells.values():
+        count = len(names)
+        if count == 1:
+            clusters.append([latSum, lonSum, names[0]])
+        else:
+            clusters.append([latSum / count, lonSum / count, '%d images' % count, names])
+    return clusters
+
+'''
+openText: opens an output file for text in UTF-8, the encoding the KML
+header declares. On Python 3 a file name that isn't valid UTF-8 (os.walk
+hands those back surrogate escaped) is written with a replacement character
+instead of failing part way through the output.
+@param: fname - file to open
+@param: mode - 'w' or 'a'
+@param: bufferSize - bytes buffered before writing out
+@param: newline - newline translation, as for io.open (Python 3 only)
+@return: file object
+'''
+def openText(fname, mode='w', bufferSize=-1, newline=None):
+    if sys.version_info[0] < 3:
+        #Python 2 writes the byte strings it's given as they are
+        return open(fname, mode, bufferSize)
+    return io.open(fname, mode, bufferSize, encoding='utf-8', errors='replace', newline=newline)
+
+'''
+placemarkKML: builds the KML object for one image
+@param: lat, lon - coords of the image in degrees
+@param: name - image file name, escaped before it goes in the KML
+@param: precision - decimal places written for each coordinate
+@param: files - for a cluster, the names of the images it stands for
+@return: KML Placemark string
+'''
+def placemarkKML(lat, lon, name, precision=COORD_PRECISION, files=None):
+    #a cluster lists its images in the description balloon
+    description = ''
+    if files:
+        description = '<description>%s</description>\n' % escape('\n'.join(files))
+    #create a KML object (according to google KML documentation)
+    return (
+        '<Placemark>\n'
+        '<name>%s</name>\n'
+        '%s'
+        '<Point>\n'
+        '<coordinates>%.*f,%.*f</coordinates>\n'
+        '</Point>\n'
+        '</Placemark>\n'
+        )%(escape(name),description,precision,lon,precision,lat)
 
 '''
 buildKMLObjects: builds KML objects from coords and filenames
@@ -155,15 +493,7 @@ def buildKMLObjects(cList):
     KMLLst = []
     #for each list(containing img name + coords) in the cList
     for imageLst in cList:
-        #create a KML object (according to google KML documentation)
-        tmpKML = (
-            '<Placemark>\n'
-            '<name>%s</name>\n'
-            '<Point>\n'
-            '<coordinates>%6f,%6f</coordinates>\n'
-            '</Point>\n'
-            '</Placemark>\n'
-            )%(imageLst[2],imageLst[1],imageLst[0])
+        tmpKML = placemarkKML(imageLst[0], imageLst[1], imageLst[2])
         #and add the kml object to the 'master list' of all KML objects created
         KMLLst.append(tmpKML)
     #return the list of KML objects
@@ -178,15 +508,15 @@ createKMLFile: writes KML objects and necessary formatting info to file
 def createKMLFile(KMLObjectArray, fname):
     #open output file
     fname = fname + '.kml'
-    outputKML = open(fname, 'w')
+    outputKML = openText(fname)
     #write KML header to output file
-    outputKML.write("<?xml version='1.0' encoding='UTF-8'?>\n<kml xmlns='http://earth.google.com/kml/2.1'>\n<Document>\n")
+    outputKML.write(KML_HEADER)
     #loop through KML Object Array and print each KML object to the file
     for obj in KMLObjectArray:
         outputKML.write(obj)
 
     #add closing formatting tags to file
-    outputKML.write("</Document>\n</kml>")
+    outputKML.write(KML_FOOTER)
     
     #close the file
     outputKML.close()
@@ -194,27 +524,334 @@ def createKMLFile(KMLObjectArray, fname):
     #print completion msg
     print("\nOutput file %s created successfully" % fname) 
 
+'''
+PlacemarkWriter: writes placemarks to an output file as they're found, so
+only the write buffer is held in memory however many images there are. The
+file is created with the first placemark and closing it writes the footer,
+so an interrupted run still leaves a loadable file of everything found so
+far. Subclasses set the extension, header and footer and format each
+placemark.
+'''
+class PlacemarkWriter(object):
+    extension = ''
+    header = ''
+    footer = ''
+
+    def __init__(self, fname, bufferSize=KML_BUFFER_SIZE, precision=COORD_PRECISION,
+                 clustered=False):
+        self.fname = fname + self.extension
+        self.bufferSize = bufferSize
+        self.precision = precision
+        #whether placemarks come from clusterCoords, for formats whose
+        #layout has to be fixed up front
+        self.clustered = clustered
+        self.output = None
+        #number of placemarks written
+        self.count = 0
+
+    #open the text stream placemarks are written to
+    def openOutput(self):
+        return openText(self.fname, 'w', self.bufferSize)
+
+    #text written for one [lat, lon, file name] list
+    def formatPlacemark(self, coords):
+        raise NotImplementedError
+
+    #write one [lat, lon, file name] list as a placemark
+    def addPlacemark(self, coords):
+        if self.output is None:
+            self.output = self.openOutput()
+            self.output.write(self.header)
+        self.output.write(self.formatPlacemark(coords))
+        self.count += 1
+
+    #write the footer and close the file, if anything was written
+    def close(self):
+        if self.output is not None:
+            self.output.write(self.footer)
+            self.output.close()
+            self.output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+'''
+KMLWriter: writes placemarks to a KML file
+'''
+class KMLWriter(PlacemarkWriter):
+    extension = '.kml'
+    header = KML_HEADER
+    footer = KML_FOOTER
+
+    def formatPlacemark(self, coords):
+        files = coords[3] if len(coords) > 3 else None
+        return placemarkKML(coords[0], coords[1], coords[2], self.precision, files)
+
+'''
+KMZWriter: writes placemarks to a KMZ file, the zipped KML Google Earth
+loads directly. On Python 3.6+ the KML is compressed as it's written, so the
+uncompressed map never exists on disk or in memory. Older Pythons write the
+KML to a temporary file beside the archive and compress it on close.
+'''
+class KMZWriter(KMLWriter):
+    extension = '.kmz'
+
+    def openOutput(self):
+        self.archive = zipfile.ZipFile(self.fname, 'w', zipfile.ZIP_DEFLATED)
+        if sys.version_info >= (3, 6):
+            #force_zip64 since the size isn't known until the end
+            member = self.archive.open('doc.kml', 'w', force_zip64=True)
+            return io.TextIOWrapper(member, encoding='utf-8', errors='replace')
+        #older zipfile can only add whole files, so stage the KML beside the archive
+        self.staged = self.fname + '.tmp'
+        return open(self.staged, 'w', self.bufferSize)
+
+    def close(self):
+        if self.output is None:
+            return
+        KMLWriter.close(self)
+        if sys.version_info < (3, 6):
+            self.archive.write(self.staged, 'doc.kml')
+            os.remove(self.staged)
+        self.archive.close()
+
+'''
+GeoJSONWriter: writes placemarks as the point features of a GeoJSON
+FeatureCollection
+'''
+class GeoJSONWriter(PlacemarkWriter):
+    extension = '.geojson'
+    header = '{"type": "FeatureCollection", "features": [\n'
+    footer = '\n]}\n'
+
+    def formatPlacemark(self, coords):
+        feature = {
+            "type": "Feature",
+            #GeoJSON positions are [longitude, latitude]
+            "geometry": {"type": "Point",
+                         "coordinates": [round(coords[1], self.precision),
+                                         round(coords[0], self.precision)]},
+            "properties": {"name": coords[2]},
+        }
+        if len(coords) > 3:
+            feature["properties"]["count"] = len(coords[3])
+            feature["properties"]["files"] = coords[3]
+        #features after the first need a separating comma
+        return (',\n' if self.count else '') + json.dumps(feature, sort_keys=True)
+
+'''
+CSVWriter: writes placemarks as latitude,longitude,name rows
+'''
+class CSVWriter(PlacemarkWriter):
+    extension = '.csv'
+
+    def __init__(self, fname, bufferSize=KML_BUFFER_SIZE, precision=COORD_PRECISION,
+                 clustered=False):
+        PlacemarkWriter.__init__(self, fname, bufferSize, precision, clustered)
+        #clustered output carries every row's image count and list, lone
+        #images included
+        if clustered:
+            self.header = self.formatRow(['latitude', 'longitude', 'name', 'count', 'files'])
+        else:
+            self.header = self.formatRow(['latitude', 'longitude', 'name'])
+
+    def openOutput(self):
+        #the csv module does its own newline handling
+        if sys.version_info[0] < 3:
+            return open(self.fname, 'wb', self.bufferSize)
+        return openText(self.fname, 'w', self.bufferSize, newline='')
+
+    #format one row with the csv module's quoting
+    def formatRow(self, fields):
+        if not hasattr(self, 'rowBuffer'):
+            self.rowBuffer = io.BytesIO() if sys.version_info[0] < 3 else io.StringIO()
+            self.rows = csv.writer(self.rowBuffer)
+        self.rowBuffer.seek(0)
+        self.rowBuffer.truncate()
+        self.rows.writerow(fields)
+        return self.rowBuffer.getvalue()
+
+    def formatPlacemark(self, coords):
+        row = ['%.*f' % (self.precision, coords[0]),
+               '%.*f' % (self.precision, coords[1]), coords[2]]
+        if self.clustered:
+            files = coords[3] if len(coords) > 3 else [coords[2]]
+            row += [len(files), ';'.join(files)]
+        return self.formatRow(row)
+
+'''
+tileBounds: finds the edges of one quadtree tile, level z splits the world
+into 2^z by 2^z tiles of equal degrees
+@param: z, x, y - tile level, column from the west and row from the south
+@return: (north, south, east, west) in degrees
+'''
+def tileBounds(z, x, y):
+    size = 2 ** z
+    west = x * 360.0 / size - 180.0
+    south = y * 180.0 / size - 90.0
+    return (south + 180.0 / size, south, west + 360.0 / size, west)
+
+'''
+regionKML: builds the Region that makes a viewer load a tile only once it
+is in view and large enough on screen
+@param: z, x, y - tile level, column and row
+@return: KML Region string
+'''
+def regionKML(z, x, y):
+    #the whole-world tile is always loaded
+    minLodPixels = TILE_LOD_PIXELS if z else 0
+    return (
+        '<Region>\n'
+        '<LatLonAltBox><north>%f</north><south>%f</south><east>%f</east><west>%f</west></LatLonAltBox>\n'
+        '<Lod><minLodPixels>%d</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod>\n'
+        '</Region>\n'
+        )%(tileBounds(z, x, y) + (minLodPixels,))
+
+'''
+networkLinkKML: builds the link from one KML file to a tile's KML file
+@param: z, x, y - tile level, column and row
+@param: href - path of the tile file relative to the linking file
+@return: KML NetworkLink string
+'''
+def networkLinkKML(z, x, y, href):
+    return (
+        '<NetworkLink>\n'
+        '<name>%d-%d-%d</name>\n'
+        '%s'
+        '<Link><href>%s</href><viewRefreshMode>onRegion</viewRefreshMode></Link>\n'
+        '</NetworkLink>\n'
+        )%(z, x, y, regionKML(z, x, y), escape(href))
+
+'''
+TiledKMLWriter: writes placemarks into a quadtree of KML tiles linked by
+Region/NetworkLink, so a viewer only loads the tiles in view at the current
+zoom. Each placemark goes into the shallowest tile on its path that still
+has room, so the coarse tiles hold a sample of the map and the deepest
+level holds whatever is left. Placemarks are appended to their tile's file
+in the one pass as they arrive. Memory is bounded by a count per tile and a
+capped set of open tile files, and closing the writer adds each tile's
+child links and closing tags.
+'''
+class TiledKMLWriter(KMLWriter):
+
+    def __init__(self, fname, bufferSize=TILE_BUFFER_SIZE, precision=COORD_PRECISION,
+                 maxDepth=TILE_DEPTH, capacity=TILE_CAPACITY, maxOpen=MAX_OPEN_TILES):
+        KMLWriter.__init__(self, fname, bufferSize, precision)
+        #the tiles sit in a directory beside the root KML file
+        self.tileDir = fname + '_tiles'
+        self.maxDepth = maxDepth
+        self.capacity = capacity
+        self.maxOpen = maxOpen
+        #(z, x, y) -> placemarks written to that tile
+        self.tileCounts = {}
+        #(z, x, y) -> open file, least recently used first
+        self.openTiles = collections.OrderedDict()
+
+    def tilePath(self, tile):
+        return os.path.join(self.tileDir, '%d-%d-%d.kml' % tile)
+
+    #get a tile's file, reopening it to append if it was closed to make room
+    def tileFile(self, tile):
+        tileFile = self.openTiles.pop(tile, None)
+        if tileFile is None:
+            if len(self.openTiles) >= self.maxOpen:
+                self.openTiles.popitem(last=False)[1].close()
+            if tile in self.tileCounts:
+                tileFile = openText(self.tilePath(tile), 'a', self.bufferSize)
+            else:
+                tileFile = openText(self.tilePath(tile), 'w', self.bufferSize)
+                tileFile.write(KML_HEADER)
+                tileFile.write(regionKML(*tile))
+                self.tileCounts[tile] = 0
+        self.openTiles[tile] = tileFile
+        return tileFile
+
+    #the shallowest tile on the coordinate's path with room left
+    def placeTile(self, lat, lon):
+        for z in range(self.maxDepth + 1):
+            size = 2 ** z
+            x = min(int((lon + 180.0) / 360.0 * size), size - 1)
+            y = min(int((lat + 90.0) / 180.0 * size), size - 1)
+            tile = (z, max(x, 0), max(y, 0))
+            if self.tileCounts.get(tile, 0) < self.capacity or z == self.maxDepth:
+                return tile
+
+    def addPlacemark(self, coords):
+        if self.output is None:
+            if not os.path.isdir(self.tileDir):
+                os.makedirs(self.tileDir)
+            #the root file just links to the whole-world tile
+            self.output = openText(self.fname)
+            self.output.write(KML_HEADER)
+            self.output.write(networkLinkKML(0, 0, 0, os.path.basename(self.tileDir) + '/0-0-0.kml'))
+            self.output.write(KML_FOOTER)
+            self.output.close()
+        #placemarks go to their tile's file rather than the single output
+        tile = self.placeTile(coords[0], coords[1])
+        self.tileFile(tile).write(self.formatPlacemark(coords))
+        self.tileCounts[tile] += 1
+        self.count += 1
+
+    #link every tile to its children and close them all off
+    def close(self):
+        if self.output is None:
+            return
+        for tileFile in self.openTiles.values():
+            tileFile.close()
+        self.openTiles.clear()
+        
+        for z, x, y in sorted(self.tileCounts):
+            tileFile = openText(self.tilePath((z, x, y)), 'a')
+            for child in [(z + 1, 2 * x + dx, 2 * y + dy) for dx in (0, 1) for dy in (0, 1)]:
+                if child in self.tileCounts:
+                    tileFile.write(networkLinkKML(child[0], child[1], child[2], '%d-%d-%d.kml' % child))
+            tileFile.write(KML_FOOTER)
+            tileFile.close()
+        self.output = None
+
+# writer for each output format
+OUTPUT_FORMATS = {
+    'kml': KMLWriter,
+    'kmz': KMZWriter,
+    'geojson': GeoJSONWriter,
+    'csv': CSVWriter,
+    'tiles': TiledKMLWriter,
+}
+
 if __name__ == '__main__':
   
-    #check for file path argument
-    if len(sys.argv) != 3:
-        print("ERROR - USAGE: mapEXIF.py <file|dir|path> <KML file destination>")
-        exit(0)    
+    parser = argparse.ArgumentParser(usage="mapEXIF.py <file|dir|path> <KML file destination> [options]")
+    parser.add_argument("imagePath")
+    parser.add_argument("outputFileName")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="worker processes (default one per core, 1 searches in this process)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="files handed to a worker at a time")
+    parser.add_argument("-f", "--format", choices=sorted(OUTPUT_FORMATS), default="kml",
+                        help="output file format (default kml)")
+    parser.add_argument("-p", "--precision", type=int, default=COORD_PRECISION,
+                        help="decimal places written per coordinate (default %d)" % COORD_PRECISION)
+    parser.add_argument("--tile-depth", type=int, default=TILE_DEPTH,
+                        help="quadtree levels below the world tile for -f tiles (default %d)" % TILE_DEPTH)
+    parser.add_argument("--tile-capacity", type=int, default=TILE_CAPACITY,
+                        help="placemarks per tile before the rest go deeper (default %d)" % TILE_CAPACITY)
+    parser.add_argument("--open-tiles", type=int, default=MAX_OPEN_TILES,
+                        help="tile files kept open at once (default %d)" % MAX_OPEN_TILES)
+    cluster = parser.add_mutually_exclusive_group()
+    cluster.add_argument("--cluster-grid", type=float, metavar="DEGREES",
+                         help="merge images in the same grid cell of this size into one placemark")
+    cluster.add_argument("--cluster-geohash", type=int, metavar="LENGTH",
+                         help="merge images sharing a geohash of this length into one placemark")
+    args = parser.parse_args()
     
     #set file path from system argument    
-    imagePath = sys.argv[1]
+    imagePath = args.imagePath
     
     #set output file name from sys arg
-    outputFileName = sys.argv[2]
-    
-    #create path type attribute
-    pathType  = "None"
-    
-    #create list to hold files if path is a dir
-    filesList = []
-    
-    #create list to hold info for each file w/ GPS coords (name + coords)
-    coordList = []
+    outputFileName = args.outputFileName
     
     #print startup msg
     print("Searching file path for GPS data...\n")
@@ -222,21 +859,8 @@ if __name__ == '__main__':
     try:
         #check if supplied filepath exists
         if os.path.exists(imagePath):
-            #check if path is a file
-            if os.path.isfile(imagePath):
-                #if so, set flag
-                pathType = "File"
-                #and add to files list
-                filesList.append(imagePath)
-            #check if path is a directory
-            elif os.path.isdir(imagePath):
-                #if so, set flag
-                pathType = "Dir"
-                #and then populate file list from directory
-                for f in os.listdir(imagePath):
-                    fullPath = os.path.join(imagePath, f)
-                    filesList.append(fullPath)              
-            else:
+            #check the path is a file or a directory
+            if not os.path.isfile(imagePath) and not os.path.isdir(imagePath):
                 #if not a file or directory, throw error + exit
                 print("ERROR: Supplied path is not a file or a directory. Exiting...")
                 sys.exit(0)
@@ -249,23 +873,28 @@ if __name__ == '__main__':
         print("ERROR: File path error. Exiting...")
         sys.exit(0)    
     
-    #if the supplied path is a file
-    if pathType == "File":
-        #simply search the single file for GPS data
-        searchJPEG(filesList[0])
-    #if path is a directory    
-    elif pathType == "Dir":
-        #loop through directory and pass files to the search method one at a time
-        for f in filesList:
-            searchJPEG(f)
-    
-    #create list of KML objects using the buildKMLObj method, passing it the list
-    #of coords gathered by the search JPEG method
-    KMLObjects = buildKMLObjects(coordList)
+    #write each image's placemark as soon as it's found, the writer closes
+    #the file off even if the search is interrupted
+    if args.format == "tiles":
+        writer = TiledKMLWriter(outputFileName, precision=args.precision, maxDepth=args.tile_depth,
+                                capacity=args.tile_capacity, maxOpen=args.open_tiles)
+    else:
+        writer = OUTPUT_FORMATS[args.format](outputFileName, precision=args.precision,
+                                             clustered=bool(args.cluster_grid or args.cluster_geohash))
+    with writer:
+        #files are listed and searched in chunks across the worker processes
+        coordsIter = harvestGPS(iterImages(imagePath), args.workers, args.chunk_size)
+        #clustering needs every image before a cell is complete, so the
+        #placemarks are written once the search is done
+        if args.cluster_grid:
+            coordsIter = clusterCoords(coordsIter, lambda lat, lon: gridKey(lat, lon, args.cluster_grid))
+        elif args.cluster_geohash:
+            coordsIter = clusterCoords(coordsIter, lambda lat, lon: geohash(lat, lon, args.cluster_geohash))
+        for coords in coordsIter:
+            writer.addPlacemark(coords)
     
-    #if the list of KMLObjects isn't empty
-    if KMLObjects:
-        #send the list and specified file name to the file writing method
-        createKMLFile(KMLObjects, outputFileName)
+    #if any placemarks were written
+    if writer.count:
+        print("\nOutput file %s created successfully" % writer.fname)
     else:
         print("No images with GPS data found. Exiting...")
\ No newline at end of file
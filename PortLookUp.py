@@ -7,6 +7,41 @@
 #Author:            Rob Cilla
 ##########################################################
 
+import os
+import re
+import sys
+import bisect
+import argparse
+import mmap
+import array
+import struct
+import threading
+
+#numpy is optional, BulkPortLookup vectorises with it when it is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#compiled index layout (little-endian):
+#   header: magic, version, number of descriptions, size of the string blob
+#   TCP description ids, one unsigned short per port 0-65535
+#   UDP description ids, one unsigned short per port 0-65535
+#   NUL separated description strings, id 0 is 'unassigned'
+INDEX_MAGIC = b'PLIX'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIII')
+PORT_SLOTS = 65536
+
+#row layout of the port table report
+ROW_FORMAT = '{:>4}  {:>8}  {:>30}'
+
+#descriptions starting with these don't count as registered services
+UNREGISTERED = ('unassigned', 'reserved')
+
+#words a description is split into for the reverse index
+TOKEN_RE = re.compile('[a-z0-9]+')
+
 '''
 CreatePortDictionary: function to build a dictionary of ports and descriptions from a text file
 @param: PortTextFile - a file that holds the port numbers and their descriptions
@@ -24,7 +59,7 @@ def CreatePortDictionary(PortTextFile):
             splitLine = line.split('  ',3)
             #check to see if the dictionary already has an entry for the port number read in from the file
             #splitLine[0] - protocol / splitLine[1] - port number / splitLine[2] - description
-            if(portDictionary.has_key(splitLine[1])):
+            if(splitLine[1] in portDictionary):
                 #if yes, add new description and protocol to entry without creating new entry
                 #dict[port][protocol] = [description]
                 portDictionary[splitLine[1]][splitLine[0]] = splitLine[2]
@@ -67,26 +102,486 @@ def PortLookup(portNumber, portDictionary):
     #return both descriptions
     return tcpPortDescription, udpPortDescription
 
-def main():
-    #open txt file of ports for reading
-    PortTextFile = open('PortList.txt')
-    #pass txt file to method to create dictionary
+'''
+PortIndex: compiled port index, the description of a port is a single array
+index into the interned description table
+'''
+class PortIndex(object):
+    def __init__(self, descriptions, tcpIds, udpIds):
+        #interned description strings, descriptions[0] is 'unassigned'
+        self.descriptions = descriptions
+        #description ids indexed by port number
+        self.tcpIds = tcpIds
+        self.udpIds = udpIds
+        #numpy copies of the tables, built on first bulk lookup
+        self.numpyTables = None
+
+    #numpy views of the id tables and the description table
+    def NumpyTables(self):
+        if self.numpyTables is None:
+            self.numpyTables = (numpy.array(self.descriptions, dtype=object),
+                                numpy.frombuffer(self.tcpIds, dtype=numpy.uint16),
+                                numpy.frombuffer(self.udpIds, dtype=numpy.uint16))
+        return self.numpyTables
+
+'''
+CreatePortIndex: function to compile the port dictionary into a PortIndex
+@param: portDictionary - dictionary of ports, protocols and descriptions
+@return: PortIndex covering ports 0-65535
+'''
+def CreatePortIndex(portDictionary):
+    #each distinct description is stored once and referred to by id
+    descriptions = ['unassigned']
+    descriptionIds = {'unassigned': 0}
+    tcpIds = array.array('H', [0]) * PORT_SLOTS
+    udpIds = array.array('H', [0]) * PORT_SLOTS
+    
+    for port, protocols in portDictionary.items():
+        #skip anything in the txt file that isn't a valid port number
+        try:
+            portNumber = int(port)
+        except ValueError:
+            continue
+        if not 0 <= portNumber < PORT_SLOTS:
+            continue
+        
+        for protocol, ids in (('TCP', tcpIds), ('UDP', udpIds)):
+            if protocol not in protocols:
+                continue
+            #strip here so lookups don't have to
+            description = protocols[protocol].strip()
+            if description not in descriptionIds:
+                descriptionIds[description] = len(descriptions)
+                descriptions.append(description)
+            ids[portNumber] = descriptionIds[description]
+    
+    return PortIndex(descriptions, tcpIds, udpIds)
+
+'''
+SavePortIndex: function to write a PortIndex to its compact binary format
+@param: portIndex - index to save
+@param: indexFileName - file to write, replaced atomically
+@return: void
+'''
+def SavePortIndex(portIndex, indexFileName):
+    blob = '\0'.join(portIndex.descriptions).encode('utf-8')
+    tcpIds = array.array('H', portIndex.tcpIds)
+    udpIds = array.array('H', portIndex.udpIds)
+    #the file format is little-endian whatever the host is
+    if sys.byteorder != 'little':
+        tcpIds.byteswap()
+        udpIds.byteswap()
+    
+    #write to a temp file and rename so readers never see half an index
+    tmpFileName = indexFileName + '.tmp'
+    indexFile = open(tmpFileName, 'wb')
+    indexFile.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION,
+                                      len(portIndex.descriptions), len(blob)))
+    indexFile.write(tcpIds.tostring() if sys.version_info[0] < 3 else tcpIds.tobytes())
+    indexFile.write(udpIds.tostring() if sys.version_info[0] < 3 else udpIds.tobytes())
+    indexFile.write(blob)
+    indexFile.close()
+    getattr(os, 'replace', os.rename)(tmpFileName, indexFileName)
+
+'''
+LoadPortIndex: function to memory-map a saved PortIndex
+@param: indexFileName - file written by SavePortIndex
+@return: PortIndex, or None if the file isn't a valid index
+'''
+def LoadPortIndex(indexFileName):
+    indexFile = open(indexFileName, 'rb')
+    try:
+        indexMap = mmap.mmap(indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        indexFile.close()
+    
+    try:
+        magic, version, count, blobSize = INDEX_HEADER.unpack_from(indexMap, 0)
+        tableSize = PORT_SLOTS * 2
+        udpStart = INDEX_HEADER.size + tableSize
+        blobStart = udpStart + tableSize
+        if (magic != INDEX_MAGIC or version != INDEX_VERSION or
+            len(indexMap) != blobStart + blobSize):
+            indexMap.close()
+            return None
+        
+        #descriptions come back as the same str type a fresh parse of the
+        #txt file gives, bytes on Python 2 and text on Python 3
+        blob = indexMap[blobStart:]
+        if sys.version_info[0] >= 3:
+            blob = blob.decode('utf-8')
+        descriptions = blob.split('\0')
+        if len(descriptions) != count:
+            indexMap.close()
+            return None
+    except:
+        #truncated header or undecodable descriptions, don't leak the mapping
+        indexMap.close()
+        raise
+    
+    if sys.version_info[0] >= 3 and sys.byteorder == 'little':
+        #view the id tables straight out of the mapping, nothing is copied
+        view = memoryview(indexMap)
+        tcpIds = view[INDEX_HEADER.size:udpStart].cast('H')
+        udpIds = view[udpStart:blobStart].cast('H')
+    else:
+        tcpIds = array.array('H')
+        udpIds = array.array('H')
+        tcpIds.fromstring(indexMap[INDEX_HEADER.size:udpStart])
+        udpIds.fromstring(indexMap[udpStart:blobStart])
+        #the tables are copies, the mapping isn't needed any more
+        indexMap.close()
+        if sys.byteorder != 'little':
+            tcpIds.byteswap()
+            udpIds.byteswap()
+    
+    return PortIndex(descriptions, tcpIds, udpIds)
+
+'''
+OpenPortIndex: function to load the compiled index, rebuilding it from the
+txt file only when the index is missing or older than the txt file
+@param: portTextFileName - txt file of port numbers and descriptions
+@param: indexFileName - compiled index kept next to it
+@param: forceRebuild - always re-parse the txt file
+@return: PortIndex
+'''
+def OpenPortIndex(portTextFileName='PortList.txt', indexFileName='PortList.idx',
+                  forceRebuild=False):
+    try:
+        if (not forceRebuild and
+            os.path.getmtime(indexFileName) >= os.path.getmtime(portTextFileName)):
+            portIndex = LoadPortIndex(indexFileName)
+            if portIndex is not None:
+                return portIndex
+    except (OSError, IOError, ValueError, struct.error):
+        #ValueError covers an empty index file (which can't be mapped) and
+        #undecodable descriptions
+        pass
+    
+    #index is missing, stale or damaged - parse the txt file once and save it
+    PortTextFile = open(portTextFileName)
     portDictionary = CreatePortDictionary(PortTextFile)
-    #close the txt file
     PortTextFile.close()
     
+    portIndex = CreatePortIndex(portDictionary)
+    try:
+        SavePortIndex(portIndex, indexFileName)
+    except (OSError, IOError):
+        #read-only location, the in-memory index still works
+        pass
+    return portIndex
+
+'''
+IndexedPortLookup: function to look up port descriptions from a PortIndex
+@param: portNumber - port number to get info for
+@param: portIndex - compiled port index
+@return: strings containing tcp and udp port descriptions
+'''
+def IndexedPortLookup(portNumber, portIndex):
+    descriptions = portIndex.descriptions
+    return (descriptions[DescriptionId(portIndex.tcpIds, portNumber)],
+            descriptions[DescriptionId(portIndex.udpIds, portNumber)])
+
+'''
+DescriptionId: function to read a port's description id from an id table
+@param: ids - tcp or udp id table
+@param: portNumber - port number, possibly out of range
+@return: description id, 0 ('unassigned') for ports outside 0-65535
+'''
+def DescriptionId(ids, portNumber):
+    #negative ports would otherwise index from the end of the table
+    if 0 <= portNumber < PORT_SLOTS:
+        return ids[portNumber]
+    return 0
+
+'''
+BulkPortLookup: function to look up the descriptions of many ports at once
+@param: portNumbers - sequence or numpy array of port numbers
+@param: portIndex - compiled port index
+@return: tcp and udp descriptions, numpy object arrays if portNumbers is a
+numpy array, otherwise lists
+'''
+def BulkPortLookup(portNumbers, portIndex):
+    if numpy is not None and isinstance(portNumbers, numpy.ndarray):
+        #two fancy-index gathers per protocol, no Python level loop
+        descriptions, tcpIds, udpIds = portIndex.NumpyTables()
+        #bad values from logs map to id 0 ('unassigned') like the baseline lookup
+        valid = (portNumbers >= 0) & (portNumbers < PORT_SLOTS)
+        slots = numpy.where(valid, portNumbers, 0)
+        return (descriptions[numpy.where(valid, tcpIds[slots], 0)],
+                descriptions[numpy.where(valid, udpIds[slots], 0)])
+    
+    descriptions = portIndex.descriptions
+    tcpIds, udpIds = portIndex.tcpIds, portIndex.udpIds
+    portNumbers = list(portNumbers)
+    if portNumbers and (min(portNumbers) < 0 or max(portNumbers) >= PORT_SLOTS):
+        #out of range ports present, check each one
+        tcpInfo = [descriptions[DescriptionId(tcpIds, port)] for port in portNumbers]
+        udpInfo = [descriptions[DescriptionId(udpIds, port)] for port in portNumbers]
+        return tcpInfo, udpInfo
+    
+    #map over bound methods keeps the loop in C
+    tcpInfo = list(map(descriptions.__getitem__, map(tcpIds.__getitem__, portNumbers)))
+    udpInfo = list(map(descriptions.__getitem__, map(udpIds.__getitem__, portNumbers)))
+    return tcpInfo, udpInfo
+
+'''
+RenderPortTable: function to build the port report for a range of ports
+@param: portIndex - compiled port index
+@param: start, stop - range of port numbers to include
+@return: report rows joined into a single string
+'''
+def RenderPortTable(portIndex, start=0, stop=65507):
+    portNumbers = range(start, stop)
+    tcpInfo, udpInfo = BulkPortLookup(portNumbers, portIndex)
+    return '\n'.join(map(ROW_FORMAT.format, portNumbers, tcpInfo, udpInfo))
+
+'''
+PortSearchIndex: reverse indexes over a PortIndex for service name and
+port range queries
+'''
+class PortSearchIndex(object):
+    def __init__(self, portIndex, descriptionPorts, tokenIds, sortedTokens,
+                 trigramIds, registeredPorts):
+        self.portIndex = portIndex
+        #description id -> list of (port, protocol) using it
+        self.descriptionPorts = descriptionPorts
+        #lower case word -> set of description ids containing it
+        self.tokenIds = tokenIds
+        #every word in sorted order, for prefix queries
+        self.sortedTokens = sortedTokens
+        #lower case 3 character substring -> set of description ids containing it
+        self.trigramIds = trigramIds
+        #protocol -> sorted list of ports with a registered service
+        self.registeredPorts = registeredPorts
+
+'''
+CreatePortSearchIndex: function to build the reverse indexes for a PortIndex
+@param: portIndex - compiled port index
+@return: PortSearchIndex
+'''
+def CreatePortSearchIndex(portIndex):
+    descriptionPorts = dict((i, []) for i in range(len(portIndex.descriptions)))
+    registeredPorts = {'TCP': [], 'UDP': []}
+    lowerDescriptions = [d.lower() for d in portIndex.descriptions]
+    
+    #ports are visited in order, so every list comes out sorted
+    for port in range(PORT_SLOTS):
+        for protocol, ids in (('TCP', portIndex.tcpIds), ('UDP', portIndex.udpIds)):
+            descriptionId = ids[port]
+            if descriptionId == 0:
+                continue
+            descriptionPorts[descriptionId].append((port, protocol))
+            if not lowerDescriptions[descriptionId].startswith(UNREGISTERED):
+                registeredPorts[protocol].append(port)
+    
+    tokenIds = {}
+    trigramIds = {}
+    for descriptionId, description in enumerate(lowerDescriptions):
+        if descriptionId == 0:
+            continue
+        for token in TOKEN_RE.findall(description):
+            tokenIds.setdefault(token, set()).add(descriptionId)
+        for i in range(len(description) - 2):
+            trigramIds.setdefault(description[i:i + 3], set()).add(descriptionId)
+    
+    return PortSearchIndex(portIndex, descriptionPorts, tokenIds, sorted(tokenIds),
+                           trigramIds, registeredPorts)
+
+'''
+ExpandDescriptionIds: function to turn matching descriptions into port entries
+@param: descriptionIds - ids of the matching descriptions
+@param: searchIndex - PortSearchIndex
+@return: sorted list of (port, protocol, description) tuples
+'''
+def ExpandDescriptionIds(descriptionIds, searchIndex):
+    descriptions = searchIndex.portIndex.descriptions
+    matches = []
+    for descriptionId in descriptionIds:
+        for port, protocol in searchIndex.descriptionPorts[descriptionId]:
+            matches.append((port, protocol, descriptions[descriptionId]))
+    matches.sort()
+    return matches
+
+'''
+FindPortsByService: function to find the ports whose description contains every word of a name
+@param: serviceName - e.g. 'kerberos' or 'kerberos password'
+@param: searchIndex - PortSearchIndex
+@return: sorted list of (port, protocol, description) tuples
+'''
+def FindPortsByService(serviceName, searchIndex):
+    tokens = TOKEN_RE.findall(serviceName.lower())
+    if not tokens:
+        return []
+    descriptionIds = set(searchIndex.tokenIds.get(tokens[0], ()))
+    for token in tokens[1:]:
+        descriptionIds &= searchIndex.tokenIds.get(token, set())
+    return ExpandDescriptionIds(descriptionIds, searchIndex)
+
+'''
+FindPortsByPrefix: function to find the ports with a description word starting with a prefix
+@param: prefix - start of a word, e.g. 'kerb'
+@param: searchIndex - PortSearchIndex
+@return: sorted list of (port, protocol, description) tuples
+'''
+def FindPortsByPrefix(prefix, searchIndex):
+    prefix = prefix.lower()
+    sortedTokens = searchIndex.sortedTokens
+    descriptionIds = set()
+    #the matching words are one contiguous run of the sorted word list
+    i = bisect.bisect_left(sortedTokens, prefix)
+    while i < len(sortedTokens) and sortedTokens[i].startswith(prefix):
+        descriptionIds |= searchIndex.tokenIds[sortedTokens[i]]
+        i += 1
+    return ExpandDescriptionIds(descriptionIds, searchIndex)
+
+'''
+FindPortsBySubstring: function to find the ports whose description contains some text
+@param: text - text to look for, case insensitive
+@param: searchIndex - PortSearchIndex
+@return: sorted list of (port, protocol, description) tuples
+'''
+def FindPortsBySubstring(text, searchIndex):
+    text = text.lower()
+    descriptions = searchIndex.portIndex.descriptions
+    if len(text) < 3:
+        #too short for the trigram index, check every distinct description
+        candidates = range(1, len(descriptions))
+    else:
+        #only descriptions holding every trigram of the text can contain it
+        candidates = None
+        for i in range(len(text) - 2):
+            ids = searchIndex.trigramIds.get(text[i:i + 3], set())
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return []
+    descriptionIds = [i for i in candidates if text in descriptions[i].lower()]
+    return ExpandDescriptionIds(descriptionIds, searchIndex)
+
+'''
+PortsInRange: function to list the registered ports in a range
+@param: low, high - inclusive port range
+@param: searchIndex - PortSearchIndex
+@param: protocol - 'TCP', 'UDP' or None for both
+@return: sorted list of (port, protocol, description) tuples
+'''
+def PortsInRange(low, high, searchIndex, protocol=None):
+    portIndex = searchIndex.portIndex
+    matches = []
+    for proto, ids in (('TCP', portIndex.tcpIds), ('UDP', portIndex.udpIds)):
+        if protocol is not None and proto != protocol:
+            continue
+        ports = searchIndex.registeredPorts[proto]
+        first = bisect.bisect_left(ports, low)
+        last = bisect.bisect_right(ports, high)
+        for port in ports[first:last]:
+            matches.append((port, proto, portIndex.descriptions[ids[port]]))
+    matches.sort()
+    return matches
+
+'''
+PortRegistry: port index that follows changes to its txt file. A reload
+builds a complete new PortIndex and then swaps it in with one assignment, so
+readers always see either the old index or the new one, never a partial one
+'''
+class PortRegistry(object):
+    def __init__(self, portTextFileName='PortList.txt', indexFileName='PortList.idx',
+                 checkInterval=5.0):
+        self.portTextFileName = portTextFileName
+        self.indexFileName = indexFileName
+        self.checkInterval = checkInterval
+        #only one reload at a time, lookups never take this lock
+        self.reloadLock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.watcher = None
+        self.sourceStamp = self.SourceStamp()
+        self.portIndex = OpenPortIndex(portTextFileName, indexFileName)
+
+    #mtime and size of the txt file, any change triggers a reload
+    def SourceStamp(self):
+        try:
+            sourceStat = os.stat(self.portTextFileName)
+        except OSError:
+            return None
+        return (sourceStat.st_mtime, sourceStat.st_size)
+
+    '''
+    Refresh: reload the index if the txt file changed since the last load
+    @return: True if a new index was swapped in
+    '''
+    def Refresh(self):
+        with self.reloadLock:
+            sourceStamp = self.SourceStamp()
+            if sourceStamp is None or sourceStamp == self.sourceStamp:
+                return False
+            #build the complete new index before anyone can see it; always
+            #re-parse, the saved index may share the txt file's mtime
+            newIndex = OpenPortIndex(self.portTextFileName, self.indexFileName, True)
+            self.portIndex = newIndex
+            self.sourceStamp = sourceStamp
+            return True
+
+    #start a background thread that checks the txt file every checkInterval seconds
+    def Start(self):
+        if self.watcher is None:
+            self.stopEvent.clear()
+            self.watcher = threading.Thread(target=self.Watch)
+            self.watcher.daemon = True
+            self.watcher.start()
+
+    def Watch(self):
+        while not self.stopEvent.wait(self.checkInterval):
+            try:
+                self.Refresh()
+            except Exception:
+                #keep serving the current index if the new file is unusable
+                pass
+
+    def Stop(self):
+        if self.watcher is not None:
+            self.stopEvent.set()
+            self.watcher.join()
+            self.watcher = None
+
+    def Lookup(self, portNumber):
+        return IndexedPortLookup(portNumber, self.portIndex)
+
+    def BulkLookup(self, portNumbers):
+        return BulkPortLookup(portNumbers, self.portIndex)
+
+def main():
+    #check for query arguments, with none the full table is printed
+    parser = argparse.ArgumentParser(description='Look up port numbers and services')
+    parser.add_argument('--service', help='ports whose description has these words')
+    parser.add_argument('--prefix', help='ports with a description word starting with this')
+    parser.add_argument('--contains', help='ports whose description contains this text')
+    parser.add_argument('--range', nargs=2, type=int, metavar=('LOW', 'HIGH'),
+                        help='registered ports between LOW and HIGH')
+    parser.add_argument('--protocol', choices=('TCP', 'UDP'), help='limit --range to one protocol')
+    args = parser.parse_args()
+    
+    #load the compiled port index, building it from the txt file if needed
+    portIndex = OpenPortIndex('PortList.txt', 'PortList.idx')
+    
+    if args.service or args.prefix or args.contains or args.range:
+        searchIndex = CreatePortSearchIndex(portIndex)
+        if args.service:
+            matches = FindPortsByService(args.service, searchIndex)
+        elif args.prefix:
+            matches = FindPortsByPrefix(args.prefix, searchIndex)
+        elif args.contains:
+            matches = FindPortsBySubstring(args.contains, searchIndex)
+        else:
+            matches = PortsInRange(args.range[0], args.range[1], searchIndex, args.protocol)
+        for port, protocol, description in matches:
+            print('{:>5}  {:<3}  {}'.format(port, protocol, description))
+        return
+    
     #print header for output
     print("PORT  TCP INFO \t\t\t    UDP INFO")
     
-    #run through port numbers 0-65506
-    for portNum in range (0, 65507): 
-        #pull tcp/udp info from the portLookup function. Pass it the current port number and the created dictionary
-        tcp_info,udp_info = PortLookup(portNum, portDictionary)
-        
-        #create an output row
-        row = '{:>4}  {:>8}  {:>30}'.format(portNum, tcp_info, udp_info)
-        #print the output
-        print(row)
+    #build rows for port numbers 0-65506 in one go and print them with a single write
+    sys.stdout.write(RenderPortTable(portIndex, 0, 65507) + '\n')
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+##########################################################
+#Name:              PortLookUpServer.py
+#Version:           0.1
+#Functionality:     Serve port lookups from a single loaded port index over a
+#Unix domain socket, so tools don't each pay to load PortList.txt
+#Author:            Rob Cilla
+##########################################################
+
+#Protocol: each request is one line of port numbers separated by spaces or
+#commas. Each reply is one line of JSON, a list of [tcp, udp] description
+#pairs in the same order as the request, or {"error": ...}. Requests may be
+#pipelined, replies always come back in request order.
+
+import os
+import sys
+import json
+import socket
+import signal
+import asyncio
+import threading
+import argparse
+
+import PortLookUp
+
+#default location of the server socket
+SOCKET_PATH = '/tmp/portlookup.sock'
+
+#longest request line accepted, room for every port several times over
+REQUEST_LIMIT = 16 * 1024 * 1024
+
+'''
+ParseRequest: function to turn a request line into port numbers
+@param: line - raw request line
+@return: list of port numbers, raises ValueError for anything invalid
+'''
+def ParseRequest(line):
+    ports = [int(p) for p in line.replace(b',', b' ').split()]
+    for port in ports:
+        #negative numbers would silently index from the end of the tables
+        if not 0 <= port < PortLookUp.PORT_SLOTS:
+            raise ValueError('port out of range: %d' % port)
+    return ports
+
+'''
+HandleClient: coroutine to answer every request on one connection
+@param: reader, writer - asyncio stream pair for the connection
+@param: registry - PortRegistry holding the current port index
+@return: void
+'''
+async def HandleClient(reader, writer, registry):
+    try:
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                #over REQUEST_LIMIT, the rest of the line can't be told apart
+                #from the next request so tell the client and hang up
+                writer.write(json.dumps({'error': 'request longer than %d bytes' % REQUEST_LIMIT}).encode('utf-8') + b'\n')
+                await writer.drain()
+                break
+            if not line:
+                break
+            try:
+                #each request sees one whole index, even if a reload swaps it meanwhile
+                tcpInfo, udpInfo = registry.BulkLookup(ParseRequest(line))
+                reply = list(zip(tcpInfo, udpInfo))
+            except ValueError as err:
+                reply = {'error': str(err)}
+            writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+            #only wait on the socket when the client has fallen behind
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+'''
+RunServer: coroutine to serve lookups on a Unix domain socket until cancelled
+@param: socketPath - path of the socket to create
+@param: registry - PortRegistry holding the current port index
+@return: void
+'''
+async def RunServer(socketPath, registry):
+    #a socket left behind by a previous run would block the bind
+    if os.path.exists(socketPath):
+        os.remove(socketPath)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: HandleClient(reader, writer, registry), path=socketPath,
+        limit=REQUEST_LIMIT)
+    async with server:
+        await server.serve_forever()
+
+'''
+PortLookupClient: blocking client for the lookup server
+'''
+class PortLookupClient(object):
+    def __init__(self, socketPath=SOCKET_PATH):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socketPath)
+        self.replies = self.sock.makefile('rb')
+
+    '''
+    Lookup: look up a batch of ports in one round trip
+    @param: portNumbers - sequence of port numbers
+    @return: list of (tcp, udp) description tuples
+    '''
+    def Lookup(self, portNumbers):
+        return self.LookupMany([portNumbers])[0]
+
+    '''
+    LookupMany: pipeline several batches, sending every request before the
+    replies have been read
+    @param: batches - sequence of port number sequences
+    @return: list of results, one list of (tcp, udp) tuples per batch
+    '''
+    def LookupMany(self, batches):
+        request = b''.join(' '.join(str(p) for p in ports).encode('ascii') + b'\n'
+                           for ports in batches)
+        #send from a second thread so a long pipeline can't deadlock with
+        #both sides blocked on full socket buffers
+        sender = threading.Thread(target=self.Send, args=(request,))
+        sender.start()
+
+        results = []
+        error = None
+        try:
+            #read every reply, even after an error, to stay in step with the server
+            for i in range(len(batches)):
+                line = self.replies.readline()
+                if not line:
+                    #the server hung up, report why if it said
+                    if error is not None:
+                        raise ValueError(error)
+                    raise ConnectionError('lookup server closed the connection')
+                reply = json.loads(line.decode('utf-8'))
+                if isinstance(reply, dict):
+                    error = error or reply['error']
+                    results.append(None)
+                else:
+                    results.append([tuple(pair) for pair in reply])
+        finally:
+            sender.join()
+        if error is not None:
+            raise ValueError(error)
+        return results
+
+    #send a request, a server that has hung up shows as EOF on the replies
+    def Send(self, request):
+        try:
+            self.sock.sendall(request)
+        except OSError:
+            pass
+
+    def Close(self):
+        self.replies.close()
+        self.sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve port lookups over a Unix socket')
+    parser.add_argument('--socket', default=SOCKET_PATH, help='socket path to listen on')
+    parser.add_argument('--port-list', default='PortList.txt', help='txt file of ports')
+    parser.add_argument('--index', default='PortList.idx', help='compiled index file')
+    parser.add_argument('--check-interval', type=float, default=5.0,
+                        help='seconds between checks of the port list for changes')
+    args = parser.parse_args()
+
+    #load the index once, every request after this is an array lookup, and
+    #reload it in the background whenever the port list changes
+    registry = PortLookUp.PortRegistry(args.port_list, args.index, args.check_interval)
+    registry.Start()
+    print('Serving port lookups on %s' % args.socket)
+    #turn a plain kill into a normal exit so the socket gets cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        asyncio.run(RunServer(args.socket, registry))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        registry.Stop()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+if __name__ == "__main__":
+    main()
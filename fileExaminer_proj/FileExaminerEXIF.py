@@ -16,8 +16,69 @@ import os           # Python Standard Library OS Module
 import time         # Python Standard Library Time Module
 import hashlib      # Python Standard Library Hashing Methods
 import sys
-from PIL import Image
-from PIL.ExifTags import TAGS, GPSTAGS
+import argparse
+import fnmatch
+import stat
+import struct
+import mmap
+import json
+import csv
+import sqlite3
+import multiprocessing
+from itertools import islice
+
+# directory walking uses os.scandir (Python 3.5+) or the scandir backport,
+# and falls back to os.listdir and lstat without either
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# size of the blocks fed to the hash objects when streaming a file (1 MiB)
+BLOCK_SIZE = 1024 * 1024
+
+# supported hash types and the hashlib constructor that implements each
+HASH_TYPES = {
+    "MD5":     "md5",
+    "SHA1":    "sha1",
+    "SHA256":  "sha256",
+    "SHA512":  "sha512",
+    "BLAKE2B": "blake2b",
+    "BLAKE2S": "blake2s",
+}
+
+# EXIF tags decoded by ripExif, every other tag is skipped
+EXIF_TAGS = {
+    0x010F: "Make",
+    0x0110: "Model",
+    0x013B: "Artist",
+    0x8769: "ExifOffset",
+    0x8825: "GPSInfo",
+    0x9003: "DateTimeOriginal",
+}
+
+# GPS tags needed to build a coordinate
+GPS_TAGS = {
+    1: "GPSLatitudeRef",
+    2: "GPSLatitude",
+    3: "GPSLongitudeRef",
+    4: "GPSLongitude",
+}
+
+# TIFF field types: (size of one value in bytes, struct format code)
+TIFF_TYPES = {
+    1:  (1, "B"),      # BYTE
+    2:  (1, "s"),      # ASCII
+    3:  (2, "H"),      # SHORT
+    4:  (4, "L"),      # LONG
+    5:  (8, "L"),      # RATIONAL
+    7:  (1, "B"),      # UNDEFINED
+    9:  (4, "l"),      # SLONG
+    10: (8, "l"),      # SRATIONAL
+}
 
 # Class: FileExaminer Class
 #
@@ -25,19 +86,31 @@ from PIL.ExifTags import TAGS, GPSTAGS
 # Methods  constructor:    Initializes the Forensic File Object and Collects Basic Attributes
 #                          File Size
 #                          MAC Times
-#                          Reads file into a buffer
+#                          Checks the file can be read (contents are loaded lazily)
+#          buffer:         Entire file contents (or a read-only mmap), only loaded when first accessed
+#          readBlocks:     Yields the file contents in blockSize chunks
+#          close:          Releases the buffer and any memory mapping
+#          iterFiles:      Lazily yields the regular files under the path
+#          fileList:       List of the files under the path (walks the tree)
 #          hashFile:       Generates the selected one-way hash of the file
+#          hashFiles:      Generates several one-way hashes in a single read pass
 #          destructor:     Deletes the Forensic File Object
 #          noDataFound:    Inform user if no EXIF data was in the path
 #          convertToDegrees: Convert raw gps data from degrees/minutes/seconds to decimal degrees
-#          printEXIFData:    Goes through master EXIF array and prints out the individual lists
-#          ripExif:        Searches for EXIF data on a single file
+#          printEXIFData:    Goes through the EXIF store and prints out each image's record
+#          exifArray:      EXIF store formatted as the original list of string lists
+#          ripExif:        Searches for EXIF data on a single file, storing or streaming the records
+#          iterExif:       Yields each image's ExifRecord as soon as it is parsed
+#          examineAll:     Stats, hashes and rips EXIF from every file using a process pool,
+#                          skipping files whose results are already in a ResultCache
+#          iterExamine:    examineAll one result at a time, walking the tree as it goes
 
-class FileExaminer:
+class FileExaminer(object):
 
     # Constructor
     
-    def __init__(self, theFile):
+    def __init__(self, theFile, blockSize=BLOCK_SIZE, include=None, exclude=None,
+                 maxDepth=None, useMmap=False):
         
         #Attributes of the Object
         
@@ -51,10 +124,23 @@ class FileExaminer:
         self.fileRead   = False
         self.md5        = ""
         self.sha1       = ""
+        #hex digests keyed by hash type, filled in by hashFiles
+        self.digests    = {}
         #added attribs
-        #exifArray is a list of lists to hold EXIF data for each image
-        self.exifArray  = []
-        self.fileList   = []
+        #exifStore holds an ExifRecord for each image
+        self.exifStore  = ExifStore()
+        #directories are walked lazily by iterFiles, see walkFiles
+        self._fileList  = []
+        self.include    = include
+        self.exclude    = exclude
+        self.maxDepth   = maxDepth
+        #file contents are only pulled into memory on request
+        self.fileName   = theFile
+        self.blockSize  = blockSize
+        self._buffer    = None
+        #map the file instead of reading it, hashing and the EXIF scan
+        #then share the page cache with every other examiner of the file
+        self.useMmap    = useMmap
         
         
         try:
@@ -81,17 +167,14 @@ class FileExaminer:
                 
                 if os.path.isfile(theFile):
                     self.fileType = "File"
-                    self.fileList.append(theFile)
+                    self._fileList.append(theFile)
                 # Is this a real file?
                 elif os.path.islink(theFile):
                     self.fileType = "Link"
                 # Is This filename actually a directory?
                 elif os.path.isdir(theFile):
                     self.fileType = "Directory"
-                    #populate file list
-                    for f in os.listdir(theFile):
-                        fullPath = os.path.join(theFile, f)
-                        self.fileList.append(fullPath)
+                    #file list is enumerated on demand by iterFiles
                 else:
                     self.fileType = "Unknown"
                 
@@ -105,13 +188,9 @@ class FileExaminer:
                 
                 if os.access(theFile, os.R_OK) and self.fileType == "File":
                     
-                    # Open the file
+                    # Make sure the file really opens, the contents are
+                    # streamed later so memory use is independent of size
                     fp = open(theFile, 'rb')
-                    
-                    # Assume we have enough space 
-                    self.buffer = fp.read()
-                   
-                    # Close the file we have the entire file in memory
                     fp.close()
                     
                     self.fileRead = True
@@ -125,33 +204,87 @@ class FileExaminer:
         except:
             self.lastError = "File Exception Raised"       
 
-    # partially completed hash file method
-    def hashFile(self,hashType):
+    # Entire file contents, read in (or mapped) on first access only
+    @property
+    def buffer(self):
+        if self._buffer is None:
+            fp = open(self.fileName, 'rb')
+            try:
+                # empty files can't be mapped
+                if self.useMmap and os.fstat(fp.fileno()).st_size > 0:
+                    self._buffer = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._buffer = fp.read()
+            finally:
+                # the mapping holds its own reference to the file
+                fp.close()
+        return self._buffer
+
+    # Yield the file in blockSize chunks so peak memory stays flat
+    def readBlocks(self):
+        # a mapping is handed over whole, the hashes read it in place
+        if self.useMmap:
+            self.buffer
         
-        # Only supports two Hash Types currently
+        # a caller already paid for the whole buffer, so reuse it
+        if self._buffer is not None:
+            yield self._buffer
+            return
         
+        fp = open(self.fileName, 'rb')
         try:
+            while True:
+                block = fp.read(self.blockSize)
+                if not block:
+                    break
+                yield block
+        finally:
+            fp.close()
+
+    # Yield the files to examine, walking directories as we go
+    def iterFiles(self):
+        if self.fileType == "Directory":
+            return walkFiles(self.fileName, self.include, self.exclude, self.maxDepth)
+        return iter(self._fileList)
+
+    # Full list of files to examine, walks the whole tree on every access
+    @property
+    def fileList(self):
+        return list(self.iterFiles())
+
+    # Generate a single hash type, see hashFiles for the supported types
+    def hashFile(self,hashType):
+        return self.hashFiles([hashType])
+
+    # Generate every requested hash type while reading the file only once
+    def hashFiles(self, hashTypes):
+        
+        try:
+            self.digests.update(hashBlocks(self.readBlocks(), hashTypes))
             
-            if hashType == "MD5":
-                hashObj = hashlib.md5()
-                hashObj.update(self.buffer)
-                self.md5 = hashObj.hexdigest().upper()
-                self.lastError = "OK"
-                return True
-            elif hashType == "SHA1":
-                hashObj = hashlib.sha1()
-                hashObj.update(self.buffer)
-                self.sha1 = hashObj.hexdigest().upper()
-                self.lastError = "OK"
-                return True
-            else:
-                self.lastError = "Invalid Hash Type Specified"
-                return False
+            # keep the original attributes populated for existing callers
+            if "MD5" in self.digests:
+                self.md5 = self.digests["MD5"]
+            if "SHA1" in self.digests:
+                self.sha1 = self.digests["SHA1"]
+            
+            self.lastError = "OK"
+            return True
+        except ValueError as err:
+            self.lastError = str(err)
+            return False
         except:
             self.lastError = "File Hash Failure"
             return False
             
+    # Release the buffer, unmapping the file if it was mapped
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = None
+
     def __del__(self):
+        self.close()
         print("INFO: Object closed")
         
     '''
@@ -169,23 +302,7 @@ class FileExaminer:
     @return: formatted gps corrds
     '''           
     def convertToDegrees(self, value):
-        #read in degrees from tuples in value list
-        d0 = value[0][0]
-        d1 = value[0][1]
-        d = float(d0) / float(d1)
-        
-        #read in minutes from tuples in value list
-        m0 = value[1][0]
-        m1 = value[1][1]
-        m = float(m0) / float(m1)
-        
-        #read in seconds from tuples in value list
-        s0 = value[2][0]
-        s1 = value[2][1]
-        s = float(s0) / float(s1)
-         
-        #return coord (lat/long) in the degree format 
-        return d + (m / 60.0) + (s / 3600.0)  
+        return convertToDegrees(value)
     
     '''
     printEXIFData: goes through master EXIF array and prints out the individual lists
@@ -194,153 +311,797 @@ class FileExaminer:
     '''      
     def printEXIFData(self):
         #check if any EXIF data was found in the file/dir - if so, print it out
-        if len(self.exifArray) > 0:
+        if len(self.exifStore) > 0:
             #print exif header
             print "====================================================================="
             print "EXIF DATA"
-            #search through the overall exifArray for lists
-            for lst in self.exifArray:
-                print("-------------")
-                #roll through each list and print the contents
-                for item in lst:
-                    print(item)
-                print("-------------")
+            #search through the store for each image's record
+            for record in self.exifStore:
+                self.printRecord(record)
+    
+    # Print a single image's record between separator lines
+    def printRecord(self, record):
+        print("-------------")
+        #roll through the record and print the contents
+        for item in record.lines():
+            print(item)
+        print("-------------")
+    
+    # EXIF data in the original list of formatted string lists
+    @property
+    def exifArray(self):
+        return [record.lines() for record in self.exifStore]
             
     '''
     ripExif: searches for EXIF data on a single file
-    @param: FileExaminer Object
+    @param: FileExaminer Object, optional callback handed each record as soon
+    as it is parsed (records are then not kept in exifStore)
     @return: void
     '''        
     #pull exif data from file    
-    def ripExif(self):
+    def ripExif(self, onResult=None):
         #run through dir or single file
-        for files in self.fileList:
-            #open first file
-            f = open(files, 'r')
-            
-            #read data from file
-            data = f.read()
-
-            #initalize pointer for this file
-            ptr = 0
-            
-            #close file
-            f.close()
-            
-            #initalize exif list for file
-            rippedExifLst = [] 
-            
-            #check for JPEG header
-            if data[ptr:ptr+2] == b'\xFF\xD8': 
-                #print("DEBUG: IT'S A JPEG!")
-                
-                #if JPEG, start search loop
-                while 1:                
-                    #check for APP1 header
-                    if data[ptr:ptr+2] == b'\xFF\xE1':
-                        #print("DEBUG: APP1 data found")
-                        #if APP1 found, check for EXIF data
-                        if data[ptr + 4:ptr + 8] == b"Exif":  
-                           #print("DEBUG: EXIF FOUND FOR %s" % files)
-
-                            pilImage = Image.open(files)
-                            EXIFData = pilImage._getexif()
-                                                   
-                            #added file name to array
-                            rippedExifLst.append("Image: %s" % files)
-            
-                            #iterate through tuples in EXIF data
-                            for tag, value in EXIFData.items():
-                                #pull value of EXIF tag
-                                tagsValue = TAGS.get(tag, tag)
-                                
-                                #for each tag in EXIF items, check against the following tags
-                                
-                                if tagsValue == 'Artist':
-                                    #if a match, append data to temp list
-                                    artistInfo = EXIFData.get(tag)
-                                    rippedExifLst.append('Artist: %s' % artistInfo)
-                            
-                                if tagsValue == 'DateTimeOriginal':
-                                    dateTime = EXIFData.get(tag)
-                                    rippedExifLst.append('Date/Time: %s' % dateTime)
-                            
-                                if tagsValue == 'Make':
-                                    cameraMake = EXIFData.get(tag)
-                                    rippedExifLst.append('Camera Make: %s' % cameraMake)
-                                    
-                                if tagsValue == 'Model':
-                                    cameraModel = EXIFData.get(tag)
-                                    rippedExifLst.append('Camera Model: %s' % cameraModel)
-                            
-                                if tagsValue == 'GPSInfo':
-                                    #create a local gps dict
-                                    gpsDict = {}
-                                    for gpsRaw in value:
-                                        #pull GPS tag from raw GPS data
-                                        gpsTag = GPSTAGS.get(gpsRaw, gpsRaw)
-                                        #populate dict with tags and values
-                                        gpsDict[gpsTag] = value[gpsRaw]
-                                        
-                                        #ensure that the dict has the required info
-                                        if (gpsDict.has_key("GPSLatitude") and
-                                            gpsDict.has_key("GPSLongitude") and 
-                                            gpsDict.has_key("GPSLongitudeRef") and
-                                            gpsDict.has_key("GPSLatitudeRef")):
-                            
-                                            #pull values from the dict
-                                            latitude = gpsDict["GPSLatitude"]
-                                            latitideRef = gpsDict["GPSLatitudeRef"]
-                                            longitude = gpsDict["GPSLongitude"]
-                                            longitudeRef = gpsDict["GPSLongitudeRef"]                                         
-                                            
-                                            #convert lat/long to degrees                                            
-                                            lat = self.convertToDegrees(latitude)
-                                            lon = self.convertToDegrees(longitude)
-                            
-                                            #correct for the lat/long reference as necessary
-                                            
-                                            if latitideRef == "S":
-                                                lat = 0 - lat
-                            
-                                            if longitudeRef == "W":
-                                                lon = 0 - lon
-                                            
-                                            #build gps output string    
-                                            gpsCoor = {"Latitude: ": lat, "Longitude: ": lon, "Latitude Reference: ": latitideRef, "Longitude Reference: ": longitudeRef}  
-                                   
-                                            #append string to temp list for this image
-                                            rippedExifLst.append('GPS Data: %s' % gpsCoor)
-                                            
-                                            #use break to ensure only 1 entry per image
-                                            break
-  
-                            
-                            #update overall object EXIF data array with list for this image
-                            self.exifArray.append(rippedExifLst)
-                            
-                            #break out of search loop
-                            break
-                        else:
-                            continue
-                            #continue searching for other APP1's w/EXIF data
-                            #print("DEBUG: No EXIF data found in this APPX ")                   
-
-                        
-                    #check for EOF or ~64K header size limit
-                    if data[ptr:ptr+2] == b'0xFFD9' or ptr > 4000:
-                        self.noDataFound()
-                        #break out of search loop
-                        break
-                    else:
-                        #keep advancing pointer to search for APP1 header
-                        ptr = ptr + 2
+        for files, record in self.ripFiles():
+            if record is None:
+                self.noDataFound()
+            elif onResult is not None:
+                #stream the record out, nothing accumulates in memory
+                onResult(record)
+            else:
+                #update overall object EXIF store with the record for this image
+                self.exifStore.append(record)
+    
+    '''
+    iterExif: yields EXIF records one at a time while the path is searched
+    @param: FileExaminer Object
+    @return: generator of ExifRecords, images without EXIF data are skipped
+    '''
+    def iterExif(self):
+        for files, record in self.ripFiles():
+            if record is not None:
+                yield record
+    
+    # Yield (file name, ExifRecord or None) for each file in the path
+    def ripFiles(self):
+        for files in self.iterFiles():
+            if (self.useMmap and self.fileType == "File" and
+                isinstance(self.buffer, mmap.mmap)):
+                #scan the headers straight out of the existing mapping
+                yield files, ripExifFile(files, self.buffer)
             else:
-                self.noDataFound()      
+                yield files, ripExifFile(files)
+    
+    '''
+    examineAll: stats, hashes and rips EXIF data from every file in the path,
+    fanning the work out over a pool of worker processes
+    @param: FileExaminer Object, see iterExamine
+    @return: list of examineFile results, in the same order as iterFiles
+    '''
+    def examineAll(self, hashTypes=("MD5", "SHA1"), workers=None, chunkSize=16,
+                   cache=None, verify=False, batchSize=1024):
+        return list(self.iterExamine(hashTypes, workers, chunkSize, cache, verify, batchSize))
+    
+    '''
+    iterExamine: stats, hashes and rips EXIF data from every file in the path.
+    Files are taken from the walk a batch at a time and the cache misses of the
+    next batch are handed to the pool while the current one is collected, so
+    work starts before the walk finishes and memory doesn't grow with the tree.
+    @param: FileExaminer Object, hash types, worker count (None = one per core,
+    1 = no pool), number of files handed to a worker at a time, optional
+    ResultCache, whether to re-examine cached files and check them against
+    the cache, and the number of files taken from the walk at a time
+    @return: generator of examineFile results, in the same order as iterFiles
+    '''
+    def iterExamine(self, hashTypes=("MD5", "SHA1"), workers=None, chunkSize=16,
+                    cache=None, verify=False, batchSize=1024):
+        pool = None if workers == 1 else multiprocessing.Pool(workers)
+        try:
+            files = self.iterFiles()
+            pending = None
+            while True:
+                batch = list(islice(files, batchSize))
+                if not batch:
+                    break
+                #start the next batch before collecting the last, the pool
+                #keeps working while results are reported
+                submitted = self.submitBatch(batch, hashTypes, pool, chunkSize, cache, verify)
+                if pending is not None:
+                    for result in self.collectBatch(pending, cache, verify):
+                        yield result
+                pending = submitted
+            if pending is not None:
+                for result in self.collectBatch(pending, cache, verify):
+                    yield result
+            if pool is not None:
+                pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+    
+    # Look a batch up in the cache and start examining the misses
+    def submitBatch(self, batch, hashTypes, pool, chunkSize, cache, verify):
+        hits = [cache.lookup(f, hashTypes) if cache is not None else None for f in batch]
+        jobs = [(f, hashTypes, self.blockSize)
+                for f, hit in zip(batch, hits) if hit is None or verify]
+        if pool is None:
+            fresh = (examineJob(job) for job in jobs)
+        else:
+            #imap hands back results in input order regardless of finish order
+            fresh = pool.imap(examineJob, jobs, chunkSize)
+        return hits, fresh
+    
+    # Yield a batch's results, slotting the fresh ones in between the cache hits
+    def collectBatch(self, pending, cache, verify):
+        hits, fresh = pending
+        for hit in hits:
+            if hit is not None and not verify:
+                result = hit
+            else:
+                result = next(fresh)
+                if cache is not None:
+                    cache.store(result)
+                    #the cache now holds the fresh digests, but flag the stale entry
+                    if verify and hit is not None and hit["digests"] != result["digests"]:
+                        result["lastError"] = "Cached Digest Mismatch"
+            
+            #keep the EXIF store in step with what ripExif would have produced
+            if result["exif"] is not None:
+                self.exifStore.append(result["exif"])
+            yield result
 
           
 # End Forensic File Class ====================================
 
+# Module Functions ===========================================
+#
+# Kept outside the class so worker processes can run them by name
+
+'''
+hashBlocks: feeds each block to every requested hash object in one pass
+@param: iterable of data blocks, hash types (see HASH_TYPES)
+@return: dict of upper case hex digests keyed by hash type
+'''
+def hashBlocks(blocks, hashTypes):
+    # build one hash object per requested type
+    hashObjs = {}
+    for hashType in hashTypes:
+        hashName = HASH_TYPES.get(hashType)
+        if hashName is None:
+            raise ValueError("Invalid Hash Type Specified")
+        # BLAKE2 is missing from older hashlib builds
+        if not hasattr(hashlib, hashName):
+            raise ValueError("Hash Type Not Available")
+        hashObjs[hashType] = getattr(hashlib, hashName)()
+    
+    # feed each block to every hash object before reading the next
+    for block in blocks:
+        for hashObj in hashObjs.values():
+            hashObj.update(block)
+    
+    return dict((hashType, hashObj.hexdigest().upper())
+                for hashType, hashObj in hashObjs.items())
+
+'''
+scandirEntries: describes the entries of an open scandir iterator, using the
+type information scandir already cached on each entry instead of stat calls
+@param: scandir iterator
+@return: generator of (name, path, is directory, is regular file)
+'''
+def scandirEntries(entries):
+    for entry in entries:
+        try:
+            #symlinks are not followed so link loops can't trap the walk
+            yield (entry.name, entry.path, entry.is_dir(follow_symlinks=False),
+                   entry.is_file(follow_symlinks=False))
+        except OSError:
+            continue
+
+'''
+listdirEntries: describes the entries of a directory with one lstat each,
+for Pythons without scandir
+@param: directory path, names from os.listdir
+@return: generator of (name, path, is directory, is regular file)
+'''
+def listdirEntries(dirPath, names):
+    for name in names:
+        path = os.path.join(dirPath, name)
+        try:
+            #lstat so symlinks are neither files nor directories, as with scandir
+            mode = os.lstat(path).st_mode
+        except OSError:
+            continue
+        yield name, path, stat.S_ISDIR(mode), stat.S_ISREG(mode)
+
+'''
+dirEntries: opens a directory for walkFiles, with scandir when available
+@param: directory path
+@return: generator of (name, path, is directory, is regular file), raises
+OSError straight away if the directory can't be read
+'''
+def dirEntries(dirPath):
+    if scandir is not None:
+        return scandirEntries(scandir(dirPath))
+    return listdirEntries(dirPath, os.listdir(dirPath))
+
+'''
+walkFiles: recursively yields the regular files under a directory
+@param: top directory, include globs, exclude globs (matched against names),
+maximum depth (0 = top directory only, None = unlimited)
+@return: generator of file paths
+'''
+def walkFiles(top, include=None, exclude=None, maxDepth=None):
+    #explicit stack so very deep trees can't hit the recursion limit
+    pending = [(top, 0)]
+    while pending:
+        dirPath, depth = pending.pop()
+        try:
+            entries = dirEntries(dirPath)
+        except OSError:
+            #unreadable directory, keep walking the rest of the tree
+            continue
+        
+        for name, path, isDir, isFile in entries:
+            if exclude and any(fnmatch.fnmatch(name, p) for p in exclude):
+                continue
+            if isDir:
+                if maxDepth is None or depth < maxDepth:
+                    pending.append((path, depth + 1))
+            elif isFile:
+                if include and not any(fnmatch.fnmatch(name, p) for p in include):
+                    continue
+                yield path
+
+'''
+convertToDegrees: takes in gps coords pulled from EXIF data and converts them to degrees
+@param: gps coords
+@return: formatted gps corrds
+'''           
+def convertToDegrees(value):
+    #read in degrees from tuples in value list
+    d0 = value[0][0]
+    d1 = value[0][1]
+    d = float(d0) / float(d1)
+    
+    #read in minutes from tuples in value list
+    m0 = value[1][0]
+    m1 = value[1][1]
+    m = float(m0) / float(m1)
+    
+    #read in seconds from tuples in value list
+    s0 = value[2][0]
+    s1 = value[2][1]
+    s = float(s0) / float(s1)
+     
+    #return coord (lat/long) in the degree format 
+    return d + (m / 60.0) + (s / 3600.0)  
+
+'''
+findExifSegment: walks the JPEG marker segments at the start of a file, jumping
+from one segment to the next using the big-endian segment lengths, until it
+finds the APP1 EXIF block or reaches the start of the image data
+@param: binary file object (anything with read and seek)
+@return: APP1 segment data starting with "Exif", None if there is no EXIF block
+'''
+def findExifSegment(fp):
+    #check for JPEG header
+    if fp.read(2) != b'\xFF\xD8':
+        return None
+    
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xFF':
+            #truncated file or lost sync with the segment structure
+            return None
+        
+        #markers may be padded with any number of 0xFF fill bytes
+        while marker[1:2] == b'\xFF':
+            marker = marker[1:2] + fp.read(1)
+            if len(marker) < 2:
+                return None
+        code = ord(marker[1:2])
+        
+        #TEM and RSTn markers stand alone without a length field
+        if code == 0x01 or 0xD0 <= code <= 0xD7:
+            continue
+        
+        #start of scan or end of image, there are no more headers
+        if code == 0xDA or code == 0xD9:
+            return None
+        
+        #segment length is big-endian and counts its own two bytes
+        lengthBytes = fp.read(2)
+        if len(lengthBytes) < 2:
+            return None
+        length = struct.unpack('>H', lengthBytes)[0] - 2
+        if length < 0:
+            return None
+        
+        #check for APP1 header
+        if code == 0xE1:
+            segment = fp.read(length)
+            if segment[:6] == b'Exif\x00\x00':
+                return segment
+            #an XMP or other APP1 block, keep searching for the EXIF one
+            continue
+        
+        #skip over the body of any other segment
+        try:
+            fp.seek(length, os.SEEK_CUR)
+        except ValueError:
+            #an mmap can't seek past its end, the segment runs off the file
+            return None
+
+'''
+readIFD: decodes the requested tags from one TIFF image file directory
+@param: memoryview of the TIFF data, offset of the IFD, struct byte order,
+dict of tag ids to names (every other tag is skipped without decoding)
+@return: dict of decoded values keyed by tag name
+'''
+def readIFD(view, offset, order, tags):
+    values = {}
+    entryCount = struct.unpack_from(order + 'H', view, offset)[0]
+    for i in range(entryCount):
+        entry = offset + 2 + i * 12
+        tag, fieldType, count = struct.unpack_from(order + 'HHL', view, entry)
+        name = tags.get(tag)
+        if name is None or fieldType not in TIFF_TYPES:
+            continue
+        size, code = TIFF_TYPES[fieldType]
+        if size * count > len(view):
+            #corrupt count, the value can't fit in the block
+            continue
+        
+        #values of 4 bytes or less are stored in the entry itself
+        if size * count > 4:
+            dataOffset = struct.unpack_from(order + 'L', view, entry + 8)[0]
+        else:
+            dataOffset = entry + 8
+        
+        if fieldType == 2:
+            #ASCII, NUL terminated
+            value = view[dataOffset:dataOffset + count].tobytes().split(b'\x00', 1)[0]
+            if not isinstance(value, str):
+                value = value.decode('latin-1')
+            values[name] = value
+        elif fieldType == 5 or fieldType == 10:
+            #rationals come back as (numerator, denominator) pairs
+            raw = struct.unpack_from('%s%d%s' % (order, count * 2, code), view, dataOffset)
+            pairs = tuple(zip(raw[0::2], raw[1::2]))
+            values[name] = pairs[0] if count == 1 else pairs
+        else:
+            raw = struct.unpack_from('%s%d%s' % (order, count, code), view, dataOffset)
+            values[name] = raw[0] if count == 1 else raw
+    return values
+
+'''
+decodeExif: decodes the tags we report straight from the APP1 EXIF block,
+without copying it or reopening the image
+@param: APP1 segment data as returned by findExifSegment
+@return: dict of values keyed by tag name, GPSInfo is a dict of GPS tags
+'''
+def decodeExif(exifSegment):
+    EXIFData = {}
+    
+    #TIFF header follows the "Exif\0\0" identifier, offsets are relative to it
+    view = memoryview(exifSegment)[6:]
+    byteOrder = view[0:2].tobytes()
+    if byteOrder == b'II':
+        order = '<'
+    elif byteOrder == b'MM':
+        order = '>'
+    else:
+        return EXIFData
+    
+    try:
+        magic, ifdOffset = struct.unpack_from(order + 'HL', view, 2)
+        if magic != 42:
+            return EXIFData
+        
+        #IFD0 holds Make/Model/Artist and the pointers to the Exif and GPS IFDs
+        EXIFData = readIFD(view, ifdOffset, order, EXIF_TAGS)
+        gpsOffset = EXIFData.pop('GPSInfo', None)
+        exifOffset = EXIFData.pop('ExifOffset', None)
+        
+        #DateTimeOriginal lives in the Exif sub-IFD
+        if exifOffset is not None:
+            EXIFData.update(readIFD(view, exifOffset, order, EXIF_TAGS))
+            EXIFData.pop('GPSInfo', None)
+            EXIFData.pop('ExifOffset', None)
+        
+        if gpsOffset is not None:
+            EXIFData['GPSInfo'] = readIFD(view, gpsOffset, order, GPS_TAGS)
+    except struct.error:
+        #truncated or corrupt block, keep whatever decoded cleanly
+        pass
+    
+    return EXIFData
+
+'''
+ripExifFile: searches for EXIF data on a single file
+@param: file name, optional mmap of the file to scan instead of opening it
+@return: ExifRecord for the image, None if the file has no EXIF data
+'''
+def ripExifFile(fileName, mapping=None):
+    if mapping is not None:
+        #an mmap reads and seeks like a file, without the extra open
+        mapping.seek(0)
+        exifSegment = findExifSegment(mapping)
+    else:
+        #only the JPEG headers are read, never the whole image
+        f = open(fileName, 'rb')
+        try:
+            exifSegment = findExifSegment(f)
+        finally:
+            f.close()
+    
+    #not a JPEG, or a JPEG without an APP1 EXIF block
+    if exifSegment is None:
+        return None
+    
+    #print("DEBUG: EXIF FOUND FOR %s" % fileName)
+    EXIFData = decodeExif(exifSegment)
+    
+    #initalize the record for this file
+    record = ExifRecord(fileName, artist=EXIFData.get('Artist'),
+                        dateTime=EXIFData.get('DateTimeOriginal'),
+                        make=EXIFData.get('Make'), model=EXIFData.get('Model'))
+    
+    gpsDict = EXIFData.get('GPSInfo', {})
+    
+    #ensure that the dict has the required info
+    if ("GPSLatitude" in gpsDict and
+        "GPSLongitude" in gpsDict and 
+        "GPSLongitudeRef" in gpsDict and
+        "GPSLatitudeRef" in gpsDict):
+        
+        #pull values from the dict
+        latitude = gpsDict["GPSLatitude"]
+        latitideRef = gpsDict["GPSLatitudeRef"]
+        longitude = gpsDict["GPSLongitude"]
+        longitudeRef = gpsDict["GPSLongitudeRef"]                                         
+        
+        #convert lat/long to degrees                                            
+        lat = convertToDegrees(latitude)
+        lon = convertToDegrees(longitude)
+        
+        #correct for the lat/long reference as necessary
+        
+        if latitideRef == "S":
+            lat = 0 - lat
+        
+        if longitudeRef == "W":
+            lon = 0 - lon
+        
+        record.lat = lat
+        record.lon = lon
+        record.latRef = latitideRef
+        record.lonRef = longitudeRef
+    
+    #hand back the record for this image
+    return record
+
+'''
+examineJob: examineFile for a pool worker, which hands over a single argument
+@param: (file name, hash types, hash block size) tuple
+@return: dict of results, see examineFile
+'''
+def examineJob(job):
+    return examineFile(*job)
+
+'''
+statKey: identifies a particular version of a file for the result cache
+@param: os.stat result
+@return: (device, inode, size, mtime in nanoseconds) tuple
+'''
+def statKey(theFileStat):
+    #Python 2 has no st_mtime_ns
+    mtimeNs = getattr(theFileStat, "st_mtime_ns", None)
+    if mtimeNs is None:
+        mtimeNs = int(theFileStat.st_mtime * 1000000000)
+    return (theFileStat.st_dev, theFileStat.st_ino, theFileStat.st_size, mtimeNs)
+
+'''
+newResult: builds an examineFile result holding the file's attributes
+@param: file name, os.stat result (None for an empty result)
+@return: dict of results with no digests or EXIF data yet
+'''
+def newResult(fileName, theFileStat=None):
+    result = {"fileName": fileName, "lastError": "OK", "macTimes": [],
+              "fileSize": 0, "uid": 0, "gid": 0, "digests": {}, "exif": None,
+              "statKey": None}
+    if theFileStat is not None:
+        result["macTimes"] = [time.ctime(theFileStat.st_mtime),
+                              time.ctime(theFileStat.st_atime),
+                              time.ctime(theFileStat.st_ctime)]
+        result["fileSize"] = theFileStat.st_size
+        result["uid"] = theFileStat.st_uid
+        result["gid"] = theFileStat.st_gid
+        result["statKey"] = statKey(theFileStat)
+    return result
+
+'''
+examineFile: collects the attributes, hashes and EXIF data of a single file
+@param: file name, hash types, hash block size
+@return: dict of results, lastError is "OK" unless something failed
+'''
+def examineFile(fileName, hashTypes=("MD5", "SHA1"), blockSize=BLOCK_SIZE):
+    result = newResult(fileName)
+    try:
+        result = newResult(fileName, os.stat(fileName))
+        
+        fp = open(fileName, 'rb')
+        try:
+            blocks = iter(lambda: fp.read(blockSize), b'')
+            result["digests"] = hashBlocks(blocks, hashTypes)
+        finally:
+            fp.close()
+        
+        result["exif"] = ripExifFile(fileName)
+    except ValueError as err:
+        result["lastError"] = str(err)
+    except:
+        result["lastError"] = "File Exception Raised"
+    return result
+
+'''
+dumpJSON: serialises a record for the JSON exports and the cache
+@param: object to serialise
+@return: JSON string
+'''
+def dumpJSON(obj):
+    if sys.version_info[0] < 3:
+        #paths and ASCII tags are raw byte strings on py2, latin-1 maps
+        #every byte so a stray one can't abort the export
+        return json.dumps(obj, encoding='latin-1')
+    return json.dumps(obj)
+
+'''
+loadJSON: reverses dumpJSON
+@param: JSON string
+@return: decoded object, with py2 strings back as byte strings
+'''
+def loadJSON(text):
+    obj = json.loads(text)
+    if sys.version_info[0] < 3:
+        obj = nativeStrings(obj)
+    return obj
+
+'''
+nativeStrings: turns the unicode strings json hands back on py2 into latin-1
+byte strings, the type examineFile produces
+@param: decoded JSON object
+@return: the same object with byte strings
+'''
+def nativeStrings(obj):
+    if isinstance(obj, dict):
+        return dict((nativeStrings(key), nativeStrings(value)) for key, value in obj.items())
+    if isinstance(obj, list):
+        return [nativeStrings(value) for value in obj]
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    return obj
+
+
+# Class: ExifRecord Class
+#
+# Desc: The EXIF fields pulled from a single image. __slots__ keeps each
+#       record small so a million images fit comfortably in memory.
+# Methods  constructor:    Stores the fields, anything not found stays None
+#          lines:          Formats the record the way printEXIFData shows it
+#          toDict:         Plain dict of the fields (JSON / cache friendly)
+#          fromDict:       Rebuilds a record from toDict output
+
+class ExifRecord(object):
+
+    __slots__ = ("path", "artist", "dateTime", "make", "model",
+                 "lat", "lon", "latRef", "lonRef")
+
+    def __init__(self, path, artist=None, dateTime=None, make=None, model=None,
+                 lat=None, lon=None, latRef=None, lonRef=None):
+        self.path     = path
+        self.artist   = artist
+        self.dateTime = dateTime
+        self.make     = make
+        self.model    = model
+        self.lat      = lat
+        self.lon      = lon
+        self.latRef   = latRef
+        self.lonRef   = lonRef
+
+    def lines(self):
+        lst = ["Image: %s" % self.path]
+        if self.artist is not None:
+            lst.append('Artist: %s' % self.artist)
+        if self.dateTime is not None:
+            lst.append('Date/Time: %s' % self.dateTime)
+        if self.make is not None:
+            lst.append('Camera Make: %s' % self.make)
+        if self.model is not None:
+            lst.append('Camera Model: %s' % self.model)
+        if self.lat is not None:
+            gpsCoor = {"Latitude: ": self.lat, "Longitude: ": self.lon, "Latitude Reference: ": self.latRef, "Longitude Reference: ": self.lonRef}
+            lst.append('GPS Data: %s' % gpsCoor)
+        return lst
+
+    def toDict(self):
+        return dict((field, getattr(self, field)) for field in self.__slots__)
+
+    @classmethod
+    def fromDict(cls, fields):
+        return cls(**fields)
+
+# Class: ExifStore Class
+#
+# Desc: Holds the ExifRecords for a run and exports them without any
+#       string parsing
+# Methods  append:         Adds a record
+#          filter:         Records matching a predicate and/or field values
+#          writeCSV:       Writes the records to an open file as CSV
+#          writeJSONLines: Writes the records to an open file, one JSON object per line
+
+class ExifStore(object):
+
+    def __init__(self):
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def append(self, record):
+        self.records.append(record)
+
+    '''
+    filter: selects records without touching any formatted text
+    @param: ExifStore Object, optional predicate, field=value pairs that must all match
+    @return: list of matching records
+    '''
+    def filter(self, predicate=None, **fields):
+        matches = []
+        for record in self.records:
+            if predicate is not None and not predicate(record):
+                continue
+            if any(getattr(record, field) != value for field, value in fields.items()):
+                continue
+            matches.append(record)
+        return matches
+
+    def writeCSV(self, fp):
+        writer = csv.writer(fp)
+        writer.writerow(ExifRecord.__slots__)
+        for record in self.records:
+            writer.writerow([getattr(record, field) for field in ExifRecord.__slots__])
+
+    def writeJSONLines(self, fp):
+        for record in self.records:
+            fp.write(dumpJSON(record.toDict()) + "\n")
+
+# End Exif Store Classes =====================================
+
+# Class: ResultCache Class
+#
+# Desc: Persistent SQLite cache of digests and EXIF data so unchanged files
+#       are skipped on later runs. Entries are keyed by (device, inode, size,
+#       mtime in ns), any change to the file gives it a new key.
+# Methods  constructor:    Opens (or creates) the cache database
+#          lookup:         Returns the cached result for a file, None on a miss
+#          store:          Saves an examineFile result
+#          invalidate:     Drops the entry for one file, or every entry
+#          prune:          Evicts the least recently used entries above maxEntries
+#          close:          Prunes, commits and closes the database
+
+class ResultCache(object):
+
+    def __init__(self, dbPath, maxEntries=1000000):
+        self.maxEntries = maxEntries
+        self.db = sqlite3.connect(dbPath)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results ("
+                        "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+                        "fileName TEXT, digests TEXT, exif TEXT, lastUsed REAL, "
+                        "PRIMARY KEY (dev, ino, size, mtime_ns))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_lru ON results (lastUsed)")
+
+    '''
+    lookup: finds the cached result for a file, if every requested digest is cached
+    @param: ResultCache Object, file name, hash types
+    @return: result dict in the examineFile format, None on a miss
+    '''
+    def lookup(self, fileName, hashTypes):
+        try:
+            theFileStat = os.stat(fileName)
+        except OSError:
+            return None
+        
+        key = statKey(theFileStat)
+        row = self.db.execute("SELECT digests, exif FROM results WHERE "
+                              "dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                              key).fetchone()
+        if row is None:
+            return None
+        
+        #same string types as examineFile, a hit is indistinguishable from a miss
+        digests = loadJSON(row[0])
+        if not all(hashType in digests for hashType in hashTypes):
+            return None
+        
+        self.db.execute("UPDATE results SET lastUsed = ? WHERE "
+                        "dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                        (time.time(),) + key)
+        
+        exif = loadJSON(row[1])
+        if isinstance(exif, dict):
+            exif = ExifRecord.fromDict(exif)
+        elif exif is not None:
+            #written by an older version, examine the file again
+            return None
+        
+        result = newResult(fileName, theFileStat)
+        result["digests"] = dict((hashType, digests[hashType]) for hashType in hashTypes)
+        result["exif"] = exif
+        return result
+
+    '''
+    store: saves a result, replacing any older entry for the same file
+    @param: ResultCache Object, examineFile result
+    @return: void
+    '''
+    def store(self, result):
+        if result["lastError"] != "OK":
+            return
+        
+        key = result["statKey"]
+        exif = result["exif"]
+        if exif is not None:
+            exif = exif.toDict()
+        #the path is only informational, keep its raw bytes whatever the encoding
+        if sys.version_info[0] < 3:
+            fileName = sqlite3.Binary(result["fileName"])
+        else:
+            fileName = sqlite3.Binary(os.fsencode(result["fileName"]))
+        try:
+            row = key + (fileName, dumpJSON(result["digests"]), dumpJSON(exif), time.time())
+            #the inode was rewritten, the old entry can never match again
+            self.db.execute("DELETE FROM results WHERE dev = ? AND ino = ?", key[:2])
+            self.db.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row)
+        except (ValueError, sqlite3.Error):
+            #one unstorable entry just goes uncached, the run carries on
+            pass
+
+    '''
+    invalidate: drops the cached entry for a file, or the whole cache
+    @param: ResultCache Object, file name (None = everything)
+    @return: void
+    '''
+    def invalidate(self, fileName=None):
+        if fileName is None:
+            self.db.execute("DELETE FROM results")
+        else:
+            theFileStat = os.stat(fileName)
+            self.db.execute("DELETE FROM results WHERE dev = ? AND ino = ?",
+                            statKey(theFileStat)[:2])
+        self.db.commit()
+
+    '''
+    prune: evicts the least recently used entries beyond maxEntries
+    @param: ResultCache Object
+    @return: void
+    '''
+    def prune(self):
+        count = self.db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.maxEntries:
+            self.db.execute("DELETE FROM results WHERE rowid IN (SELECT rowid FROM "
+                            "results ORDER BY lastUsed LIMIT ?)", (count - self.maxEntries,))
+
+    def close(self):
+        self.prune()
+        self.db.commit()
+        self.db.close()
+
+# End Result Cache Class =====================================
+
 #
 # ------ MAIN SCRIPT STARTS HERE -----------------
 #
@@ -352,16 +1113,41 @@ if __name__ == '__main__':
     imgDir = False
     
     #check for args
-    if len(sys.argv) != 2:
-        print("ERROR - USAGE: FileExaminer.py <file|dir|path>")
-        exit(0)    
+    parser = argparse.ArgumentParser(usage="FileExaminer.py [options] <file|dir|path>")
+    parser.add_argument("path")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="examine a directory with a pool of N processes (0 = cores)")
+    parser.add_argument("-s", "--serial", action="store_true",
+                        help="examine a directory one file at a time")
+    parser.add_argument("-i", "--include", action="append",
+                        help="only examine file names matching this glob (repeatable)")
+    parser.add_argument("-x", "--exclude", action="append",
+                        help="skip file and directory names matching this glob (repeatable)")
+    parser.add_argument("-d", "--max-depth", type=int, default=None,
+                        help="how many directory levels to descend (default: all)")
+    parser.add_argument("-m", "--mmap", action="store_true",
+                        help="memory-map a single file rather than reading it")
+    parser.add_argument("-c", "--cache",
+                        help="SQLite file caching results between runs of a directory")
+    parser.add_argument("--cache-size", type=int, default=1000000,
+                        help="most files to keep in the cache (least recently used go first)")
+    parser.add_argument("--verify-cache", action="store_true",
+                        help="re-examine cached files and report any digest mismatch")
+    parser.add_argument("--invalidate-cache", action="store_true",
+                        help="empty the cache before examining")
+    parser.add_argument("--csv", help="also export the EXIF records to this CSV file")
+    parser.add_argument("--jsonl", help="also export the EXIF records to this JSON Lines file")
+    parser.add_argument("--stream", action="store_true",
+                        help="print (and export to --csv/--jsonl) each EXIF record as soon as it is found")
+    args = parser.parse_args()
     
     # a forensic file object
     
     print("File Examainer Object Test \n")
 
-    filePath = sys.argv[1]
-    FEobj = FileExaminer(filePath)
+    filePath = args.path
+    FEobj = FileExaminer(filePath, include=args.include, exclude=args.exclude,
+                         maxDepth=args.max_depth, useMmap=args.mmap)
     
     if FEobj.lastError == "OK":
     
@@ -379,11 +1165,60 @@ if __name__ == '__main__':
             else:
                 print(FEobj.lastError)
         
-        #perform the EXIF search
-        FEobj.ripExif()
+        if FEobj.fileType == "Directory" and not (args.serial or args.stream):
+            cache = None
+            if args.cache:
+                cache = ResultCache(args.cache, args.cache_size)
+                if args.invalidate_cache:
+                    cache.invalidate()
+            
+            #stat, hash and rip EXIF for every file in parallel
+            for result in FEobj.iterExamine(workers=args.workers or None, cache=cache,
+                                            verify=args.verify_cache):
+                if result["lastError"] == "OK":
+                    print("SHA1: ", result["digests"]["SHA1"], result["fileName"])
+                else:
+                    print("Last Error: ", result["lastError"], result["fileName"])
+            
+            if cache is not None:
+                cache.close()
+        elif args.stream:
+            print("=====================================================================")
+            print("EXIF DATA")
+            jsonFile = open(args.jsonl, 'w') if args.jsonl else None
+            csvFile = open(args.csv, 'w') if args.csv else None
+            if csvFile is not None:
+                csvRows = csv.writer(csvFile)
+                csvRows.writerow(ExifRecord.__slots__)
+            #report each record as it is parsed instead of at the end
+            for record in FEobj.iterExif():
+                FEobj.printRecord(record)
+                if jsonFile is not None:
+                    jsonFile.write(dumpJSON(record.toDict()) + "\n")
+                    jsonFile.flush()
+                if csvFile is not None:
+                    csvRows.writerow([getattr(record, field) for field in ExifRecord.__slots__])
+                    csvFile.flush()
+            if jsonFile is not None:
+                jsonFile.close()
+            if csvFile is not None:
+                csvFile.close()
+        else:
+            #perform the EXIF search
+            FEobj.ripExif()
         
         #print the EXIF data (if any)
         FEobj.printEXIFData()
+        
+        if args.csv and not args.stream:
+            outFile = open(args.csv, 'w')
+            FEobj.exifStore.writeCSV(outFile)
+            outFile.close()
+        
+        if args.jsonl and not args.stream:
+            outFile = open(args.jsonl, 'w')
+            FEobj.exifStore.writeJSONLines(outFile)
+            outFile.close()
        
         del FEobj
         
@@ -7,97 +7,550 @@
 #Author:            Rob Cilla
 ##########################################################
 
+import os
 import sys
 import time
 import multiprocessing
 import hashlib
 import re
+import argparse
+import json
+import collections
+try:
+    from queue import Full, Empty
+except ImportError:
+    from Queue import Full, Empty
+
+#size of the byte range each search process scans
+CHUNK_SIZE = 16 * 1024 * 1024
+#bytes read either side of a chunk, must be longer than any match
+CHUNK_OVERLAP = 4096
+
+#bytes read at a time when hashing a file on its own
+HASH_BLOCK_SIZE = 1024 * 1024
+
+#blocks the shared reader hands to the hash and search consumers
+PIPE_BLOCK_SIZE = 4 * 1024 * 1024
+#blocks a consumer may fall behind before the reader waits for it
+PIPE_DEPTH = 8
+#seconds between checks that the other stages are still running
+STAGE_POLL = 0.5
+
+#high resolution timer for measuring a stage's time split
+Clock = getattr(time, 'perf_counter', time.time)
+
+#columns of the stage summary table
+STATS_FORMAT = '{:<8} {:>10} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8}'
+
+#patterns searched for by default, when two could match at the same offset
+#the one listed first wins
+DEFAULT_PATTERNS = [
+    ('url',        r"https?://[^\s<>\"']+"),
+    ('email',      r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}'),
+    ('btc',        r'\b(?:bc1[a-z0-9]{25,39}|[13][a-km-zA-HJ-NP-Z1-9]{25,34})\b'),
+    ('ipv4',       r'\b(?:(?:25[0-5]|2[0-4]\d|1?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|1?\d?\d)\b'),
+    ('creditcard', r'\b(?:\d[ -]?){12,18}\d\b'),
+    ('phone',      r'1?-?([(]\d{3}[)]|\d{3})?(-?|\s)\d{3}(-?|\s)\d{4}'),
+]
+
+'''
+PatternSet: named regular expressions compiled into a single alternation, so
+any number of patterns costs one pass over the data. The name of the pattern
+behind each match is the match's lastgroup.
+'''
+class PatternSet(object):
+    def __init__(self, patterns=DEFAULT_PATTERNS):
+        #ordered (name, pattern) pairs, names must be valid identifiers
+        self.patterns = list(patterns)
+        self.compiled = None
+
+    #add another pattern, it is tried after the existing ones
+    def Add(self, name, pattern):
+        self.patterns.append((name, pattern))
+        self.compiled = None
+
+    #compile every pattern into one bytes regex of named alternatives
+    def Compile(self):
+        if self.compiled is None:
+            combined = '|'.join('(?P<%s>%s)' % (name, pattern) for name, pattern in self.patterns)
+            self.compiled = re.compile(combined.encode('latin-1'))
+        return self.compiled
+
+'''
+StageStats: counters for one stage of a run, filled in by the process doing
+the stage and sent back on the result queue
+'''
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.matches = 0
+        #seconds spent blocked reading the file, working on the data, and
+        #blocked on a queue waiting for another stage
+        self.ioTime = 0.0
+        self.cpuTime = 0.0
+        self.queueWait = 0.0
+        #wall clock times, so they compare across processes
+        self.startTime = time.time()
+        self.endTime = None
+
+    #mark the stage done
+    def Finish(self):
+        self.endTime = time.time()
+        return self
+
+    def Elapsed(self):
+        return (self.endTime or time.time()) - self.startTime
+
+    #bytes per second over the whole stage
+    def Rate(self):
+        return self.bytes / max(self.Elapsed(), 1e-9)
+
+    def ToDict(self):
+        return {
+            'stage': self.name,
+            'bytes': self.bytes,
+            'bytesPerSec': round(self.Rate(), 1),
+            'matches': self.matches,
+            'ioTime': round(self.ioTime, 6),
+            'cpuTime': round(self.cpuTime, 6),
+            'queueWait': round(self.queueWait, 6),
+            'elapsed': round(self.Elapsed(), 6),
+        }
+
+'''
+PrintStats: prints the stats of every stage of a run
+@param: stages - list of StageStats
+@param: style - 'table' for a summary table, 'json' for one JSON object per line
+@return: void
+'''
+def PrintStats(stages, style='table'):
+    if style == 'json':
+        for stage in stages:
+            print(json.dumps(stage.ToDict(), sort_keys=True))
+        return
+    print(STATS_FORMAT.format('stage', 'MB', 'MB/s', 'matches', 'io s', 'cpu s', 'wait s', 'total s'))
+    for stage in stages:
+        print(STATS_FORMAT.format(stage.name, '%.1f' % (stage.bytes / 1048576.0),
+                                  '%.1f' % (stage.Rate() / 1048576.0), stage.matches,
+                                  '%.3f' % stage.ioTime, '%.3f' % stage.cpuTime,
+                                  '%.3f' % stage.queueWait, '%.3f' % stage.Elapsed()))
+
+'''
+HashStream: sha512 hashes an open binary file a block at a time, so memory use
+stays at one block whatever the file size
+@param: targetFile - file object opened in binary mode
+@param: blockSize - bytes read at a time
+@param: reuseBuffer - readinto one bytearray instead of allocating every block
+@param: stats - StageStats to add the bytes and io/cpu split to
+@return: (hex digest, bytes hashed)
+'''
+def HashStream(targetFile, blockSize=HASH_BLOCK_SIZE, reuseBuffer=True, stats=None):
+    if stats is None:
+        stats = StageStats('hash')
+    hashObj = hashlib.sha512()
+    total = 0
+    if reuseBuffer and hasattr(targetFile, 'readinto'):
+        buf = bytearray(blockSize)
+        view = memoryview(buf)
+        while True:
+            readStart = Clock()
+            count = targetFile.readinto(buf)
+            readEnd = Clock()
+            stats.ioTime += readEnd - readStart
+            if not count:
+                break
+            #only the filled part of the buffer on the final short read
+            hashObj.update(view[:count])
+            stats.cpuTime += Clock() - readEnd
+            total += count
+    else:
+        while True:
+            readStart = Clock()
+            block = targetFile.read(blockSize)
+            readEnd = Clock()
+            stats.ioTime += readEnd - readStart
+            if not block:
+                break
+            hashObj.update(block)
+            stats.cpuTime += Clock() - readEnd
+            total += len(block)
+    stats.bytes += total
+    return hashObj.hexdigest(), total
 
 '''
 Hashfile: performs sha512 hash on file
 @param: queue - queue to hold process result
 @param: fileName - name of file to be hashed
-@return: updates queue with function completion time
+@param: blockSize - bytes read at a time
+@param: reuseBuffer - readinto one bytearray instead of allocating every block
+@return: updates queue with the StageStats of the hash
 '''
-def HashFile(queue, fileName):
-    #use try/catch to attempt to open file with name fileName
+def HashFile(queue, fileName, blockSize=HASH_BLOCK_SIZE, reuseBuffer=True):
+    #use try/catch to attempt to open file with name fileName, binary mode so
+    #the digest is of the bytes on disk on every platform
     try:
-        targetFile = open(fileName, 'r')
-        fToHash = targetFile.read()
-        targetFile.close()
+        targetFile = open(fileName, 'rb')
     except IOError:
         print('%s cannot be opened...' % fileName)
         return None 
     
+    stats = StageStats('hash')
     try:
-        #initalize hash object w/ sha512
-        hashObj = hashlib.sha512()
-        #update with read-in file data to get hash
-        hashObj.update(fToHash)
+        digest, total = HashStream(targetFile, blockSize, reuseBuffer, stats)
+        stats.Finish()
         
-        #check if hashObj is null
-        if hashObj:
-            #if not print header
-            print('SHA512 HASH OF %s:' % fileName)
-            #and print out hexdigest of calculated hash
-            print(hashObj.hexdigest() + '\n') 
-        #get rid of the hash object when finished with it
-        del hashObj
+        print('SHA512 HASH OF %s:' % fileName)
+        print(digest)
+        print('%d bytes hashed at %.1f MB/s\n' % (total, stats.Rate() / (1024.0 * 1024.0)))
     #exit the prgm if the hashing throws an error
-    except Exception:
+    except (IOError, OSError):
         print("ERROR: Problem calculating hash, exiting...")
         exit(0)
-    #update queue with time the function finished    
-    queue.put(time.time())
+    finally:
+        targetFile.close()
+    #update queue with the stage's stats, endTime is when it finished
+    queue.put(stats)
+
+'''
+ScanChunk: finds every match of a regular expression in one byte range of a file
+@param: job - (fileName, start, end, overlap, pattern, flags) tuple
+@return: (hits, seconds reading, seconds searching), hits being a list of
+(byte offset, pattern name, matched bytes) for matches starting in
+[start, end), the name is None for a plain regex
+'''
+def ScanChunk(job):
+    fileName, start, end, overlap, pattern, flags = job
+    #read a little either side so matches straddling the edges are seen whole,
+    #and so the regex is already in step with the data when the range begins
+    readStart = max(0, start - overlap)
+    ioStart = Clock()
+    targetFile = open(fileName, 'rb')
+    try:
+        targetFile.seek(readStart)
+        data = targetFile.read(end + overlap - readStart)
+    finally:
+        targetFile.close()
+    cpuStart = Clock()
+    
+    hits = MatchRange(data, readStart, start, end, pattern, flags)
+    return hits, cpuStart - ioStart, Clock() - cpuStart
+
+'''
+MatchRange: finds the matches starting in one byte range of some data
+@param: data - bytes holding the range plus any overlap either side
+@param: dataStart - file offset of the first byte of data
+@param: start, end - file offsets of the range, matches starting in
+[start, end) are kept
+@param: pattern, flags - bytes regular expression and its flags
+@return: list of (byte offset, pattern name, matched bytes)
+'''
+def MatchRange(data, dataStart, start, end, pattern, flags):
+    hits = []
+    for match in re.finditer(re.compile(pattern, flags), data):
+        offset = dataStart + match.start()
+        #matches in the overlap belong to the neighbouring range
+        if offset < start:
+            continue
+        if offset >= end:
+            break
+        hits.append((offset, match.lastgroup, match.group(0)))
+    return hits
+
+'''
+ScanBlock: finds the matches in one block handed over by the shared reader
+@param: job - (data, dataStart, start, end, pattern, flags) tuple, see MatchRange
+@return: (hits, seconds searching)
+'''
+def ScanBlock(job):
+    cpuStart = Clock()
+    hits = MatchRange(*job)
+    return hits, Clock() - cpuStart
+
+'''
+BytesPattern: gets the pattern and flags to search bytes with
+@param: regExp - compiled regular expression or PatternSet
+@return: (bytes pattern, flags)
+'''
+def BytesPattern(regExp):
+    if isinstance(regExp, PatternSet):
+        regExp = regExp.Compile()
+    pattern = regExp.pattern
+    if not isinstance(pattern, bytes):
+        pattern = pattern.encode('latin-1')
+    return pattern, regExp.flags & ~re.UNICODE
+
+'''
+ScanFile: splits a file into byte ranges and searches them across a process pool
+@param: fileName - name of file to be searched
+@param: regExp - compiled regular expression or PatternSet to search for
+@param: chunkSize - bytes per work unit
+@param: overlap - bytes read past each edge of a chunk
+@param: processes - size of the pool (None = one per core)
+@param: stats - StageStats to add bytes, matches and the workers' io/cpu
+split to, the times are summed over the workers
+@return: generator of (byte offset, pattern name, matched bytes) in file order
+'''
+def ScanFile(fileName, regExp, chunkSize=CHUNK_SIZE, overlap=CHUNK_OVERLAP, processes=None, stats=None):
+    #the chunks are bytes, so the pattern has to be as well
+    pattern, flags = BytesPattern(regExp)
+    
+    fileSize = os.path.getsize(fileName)
+    jobs = [(fileName, start, min(start + chunkSize, fileSize), overlap, pattern, flags)
+            for start in range(0, fileSize, chunkSize)]
+    
+    pool = multiprocessing.Pool(processes)
+    try:
+        #imap hands the chunks back in file order
+        for job, (hits, ioTime, cpuTime) in zip(jobs, pool.imap(ScanChunk, jobs)):
+            if stats is not None:
+                stats.bytes += job[2] - job[1]
+                stats.matches += len(hits)
+                stats.ioTime += ioTime
+                stats.cpuTime += cpuTime
+            for hit in hits:
+                yield hit
+    finally:
+        pool.close()
+        pool.join()
 
 '''
 SearchFile: searches for formatted data in file using supplied regex
 @param: queue - queue to hold process result
 @param: fileName - name of file to be hashed
-@param: regExp - compiled regular expression to search for something
-@return: updates queue with function completion time
+@param: regExp - compiled regular expression or PatternSet to search for
+@return: updates queue with the StageStats of the search
 '''    
 def SearchFile(queue, fileName, regExp):
-    #use try/catch to attempt to open file with name fileName  
+    #make sure the file can be opened before starting the pool
     try:
-        fToSearch = open(fileName, 'r')
+        open(fileName, 'rb').close()
     except IOError:
             print("%s cannot be opened..." % fileName)
             return None     
     #print header
-    print('PHONE NUMBERS FOUND IN %s:' % fileName)
-    #go through each line in the file
-    for line in fToSearch:
-        #search the line for the supplied regular expression
-        result = re.search(regExp, line)
-        #if there is a match
-        if result:
-            #print it
-            print(result.group(0))
+    print('MATCHES FOUND IN %s:' % fileName)
+    stats = StageStats('search')
+    #scan the file in parallel chunks, printing every match with its offset
+    for offset, kind, match in ScanFile(fileName, regExp, stats=stats):
+        print('%d: %s %s' % (offset, kind or 'match', match.decode('latin-1')))
       
     print('\n')  
     
-    #close the file        
-    fToSearch.close() 
-    #update queue with function completion time
-    queue.put(time.time())
+ 
+    #update queue with the stage's stats, endTime is when it finished
+    queue.put(stats.Finish())
+    
+'''
+HashConsumer: sha512 hashes the blocks handed over by the shared reader
+@param: blockQueue - queue of blocks, None marks the end of the file
+@param: resultQueue - queue to hold process result
+@param: fileName - name of file being hashed, for the output header
+@return: updates resultQueue with the StageStats of the hash
+'''
+def HashConsumer(blockQueue, resultQueue, fileName):
+    stats = StageStats('hash')
+    hashObj = hashlib.sha512()
+    while True:
+        waitStart = Clock()
+        block = blockQueue.get()
+        waitEnd = Clock()
+        stats.queueWait += waitEnd - waitStart
+        if block is None:
+            break
+        hashObj.update(block)
+        stats.cpuTime += Clock() - waitEnd
+        stats.bytes += len(block)
+    
+    print('SHA512 HASH OF %s:' % fileName)
+    print(hashObj.hexdigest() + '\n')
+    resultQueue.put(stats.Finish())
+
+'''
+PutChecked: puts an item on a bounded queue, giving up if the process
+reading it has died rather than waiting forever on a full queue
+@param: queue - queue to put on
+@param: item - item to put
+@param: process - process reading the queue
+@return: void, raises RuntimeError if the process is gone
+'''
+def PutChecked(queue, item, process):
+    while True:
+        try:
+            queue.put(item, True, STAGE_POLL)
+            return
+        except Full:
+            if not process.is_alive():
+                raise RuntimeError('%s stopped with exit code %s' % (process.name, process.exitcode))
+
+'''
+GetChecked: gets an item from a queue, giving up if the process writing it
+has died without putting anything
+@param: queue - queue to get from
+@param: process - process writing the queue
+@return: the item, raises RuntimeError if the process is gone
+'''
+def GetChecked(queue, process):
+    while True:
+        try:
+            return queue.get(True, STAGE_POLL)
+        except Empty:
+            if not process.is_alive():
+                #an item put just before the process exited is already queued
+                try:
+                    return queue.get_nowait()
+                except Empty:
+                    raise RuntimeError('%s stopped with exit code %s' % (process.name, process.exitcode))
+
+'''
+CollectHits: prints the matches of the oldest block handed to the search pool
+@param: result - AsyncResult of ScanBlock
+@param: stats - StageStats of the search
+@return: void, re-raises anything the search raised
+'''
+def CollectHits(result, stats):
+    waitStart = Clock()
+    hits, cpuTime = result.get()
+    stats.queueWait += Clock() - waitStart
+    stats.cpuTime += cpuTime
+    stats.matches += len(hits)
+    for offset, kind, match in hits:
+        print('%d: %s %s' % (offset, kind or 'match', match.decode('latin-1')))
+
+'''
+RunPipeline: reads the file once, handing each block to a hash consumer
+process through a bounded queue and to a pool of search processes, so the
+two stages share one pass over the disk and the search still uses every core
+@param: fileName - name of file to hash and search
+@param: regExp - compiled regular expression or PatternSet to search for
+@param: blockSize - bytes read at a time
+@param: depth - blocks either stage may fall behind the reader
+@param: overlap - bytes of the neighbouring blocks searched with each block,
+must be longer than any match
+@param: processes - size of the search pool (None = one per core)
+@return: dict of stage name -> StageStats, 'read' being the reader's, None if
+the file can't be opened; raises if a stage fails, after stopping the others
+'''
+def RunPipeline(fileName, regExp, blockSize=PIPE_BLOCK_SIZE, depth=PIPE_DEPTH,
+                overlap=CHUNK_OVERLAP, processes=None):
+    try:
+        targetFile = open(fileName, 'rb')
+    except IOError:
+        print('%s cannot be opened...' % fileName)
+        return None
+    
+    pattern, flags = BytesPattern(regExp)
+    resultQueue = multiprocessing.Queue()
+    hashQueue = multiprocessing.Queue(depth)
+    hasher = multiprocessing.Process(target=HashConsumer, args=(hashQueue, resultQueue, fileName),
+                                     name='hash stage')
+    hasher.start()
+    pool = multiprocessing.Pool(processes)
+    #search results not yet printed, oldest first
+    pending = collections.deque()
     
+    print('MATCHES FOUND IN %s:' % fileName)
+    stats = StageStats('read')
+    searchStats = StageStats('search')
+    try:
+        #a block is handed to the search once the next one is read, so it can
+        #carry the overlap from both sides like a ScanFile chunk
+        lead = b''
+        previous = None
+        offset = 0
+        while True:
+            readStart = Clock()
+            block = targetFile.read(blockSize)
+            readEnd = Clock()
+            stats.ioTime += readEnd - readStart
+            if block:
+                stats.bytes += len(block)
+                #a full queue means the hash is behind, so wait
+                PutChecked(hashQueue, block, hasher)
+                stats.queueWait += Clock() - readEnd
+            
+            if previous is not None:
+                job = (lead + previous + block[:overlap], offset - len(lead),
+                       offset, offset + len(previous), pattern, flags)
+                pending.append(pool.apply_async(ScanBlock, (job,)))
+                searchStats.bytes += len(previous)
+                offset += len(previous)
+                lead = (lead + previous)[-overlap:]
+                #likewise wait for the search once it is depth blocks behind
+                while len(pending) >= depth:
+                    CollectHits(pending.popleft(), searchStats)
+            
+            if not block:
+                break
+            previous = block
+        
+        PutChecked(hashQueue, None, hasher)
+        while pending:
+            CollectHits(pending.popleft(), searchStats)
+        print('\n')
+        searchStats.Finish()
+        stats.Finish()
+        
+        hashStats = GetChecked(resultQueue, hasher)
+        hasher.join()
+        pool.close()
+    except:
+        #one stage failed, don't leave the other waiting on it, and don't
+        #wait at exit to flush blocks nobody will read
+        hasher.terminate()
+        hashQueue.cancel_join_thread()
+        raise
+    finally:
+        targetFile.close()
+        pool.terminate()
+        pool.join()
+    
+    return {'read': stats, 'hash': hashStats, 'search': searchStats}
+
 #MAIN   
 def main():
     #check that there was a filename argument passed
-    if len(sys.argv) != 2:
-        print("ERROR: Please include the name of the file as an argument")
-        exit(0)
+    parser = argparse.ArgumentParser(description='Hash a file while searching it for phone numbers, emails and more')
+    parser.add_argument('fileName')
+    parser.add_argument('--separate', action='store_true',
+                        help='hash and search with two processes that each read the file')
+    parser.add_argument('--block-size', type=int, default=None,
+                        help='bytes read at a time')
+    parser.add_argument('--no-readinto', dest='reuseBuffer', action='store_false',
+                        help='allocate a new block per read when hashing with --separate')
+    parser.add_argument('--stats', choices=['table', 'json', 'none'], default='table',
+                        help='print per stage stats as a summary table or JSON lines')
+    args = parser.parse_args()
     #pull filename from argument    
-    fileName = sys.argv[1]
+    fileName = args.fileName
+    
+    #phone numbers, emails, card numbers, IPs, URLs and BTC addresses in one pass
+    regex = PatternSet()
+    
+    if not args.separate:
+        startTime = time.time()
+        #read the file once and feed both stages from it
+        try:
+            results = RunPipeline(fileName, regex, args.block_size or PIPE_BLOCK_SIZE)
+        except Exception as err:
+            print('ERROR: %s, exiting...' % err)
+            sys.exit(1)
+        if results is None:
+            exit(0)
+        endTime = time.time() - startTime
+        
+        print('Hashing stage completed in %s seconds' % (results['hash'].endTime - startTime))
+        print('Search stage completed in %s seconds' % (results['search'].endTime - startTime))
+        print('Entire program completed in %s seconds' % endTime)
+        if args.stats != 'none':
+            PrintStats([results['read'], results['hash'], results['search']], args.stats)
+        return
     
     #setup queue to hold thread results
     q = multiprocessing.Queue()
-    #compile regular expression to search for phone numbers of various formats
-    regex = re.compile("1?-?([(]\d{3}[)]|\d{3})?(-?|\s)\d{3}(-?|\s)\d{4}")
     
     #set up processes to call functions while passing the appropriate parameters
-    hashProcess = multiprocessing.Process(target=HashFile, args=(q, fileName,))
+    hashProcess = multiprocessing.Process(target=HashFile, args=(q, fileName, args.block_size or HASH_BLOCK_SIZE, args.reuseBuffer))
     searchThread = multiprocessing.Process(target=SearchFile, args=(q, fileName, regex))
     
     #record thread start times
@@ -106,9 +559,10 @@ def main():
     hashProcess.start()
     searchThread.start()
     
-    #get the time each thread finished (order is determined by which thread was executed first)
-    hTime = q.get() - startTime
-    sTime = q.get() - startTime
+    #get the stats of each thread (order is determined by which thread finished first)
+    stages = dict((stage.name, stage) for stage in [q.get(), q.get()])
+    hTime = stages['hash'].endTime - startTime
+    sTime = stages['search'].endTime - startTime
     
     #join the processes to close them
     hashProcess.join()
@@ -120,6 +574,8 @@ def main():
     print('Hashing thread completed in %s seconds' % hTime)
     print('Search thread completed in %s seconds' % sTime)
     print('Entire program completed in %s seconds' % endTime)
+    if args.stats != 'none':
+        PrintStats([stages['hash'], stages['search']], args.stats)
 
 if __name__ == "__main__":
     main()